@@ -8,9 +8,17 @@ __license__ = "GPLv3"
 
 from .errors import *
 from .monica import *
+from .monica_transport import *
 from .status_indicator import *
 from .status_tile import *
 from .tile_master import *
 from .monica_point import *
 from .colours import *
+from .series_buffer import *
+from .snapshot import *
+from .scheduler import *
+from .virtual_tile import *
+from .tile_fleet import *
+from .layout import *
+from .metrics import *
 
@@ -105,3 +105,19 @@ class TileCommunicationError(StatusError):
     return ("TileCommunicationError: call to %s did not work in %s, %s" %
             (self.method, self.routine, self.message))
   
+
+class MoniCACommunicationError(StatusError):
+  ## Exception raised when a request to the MoniCA web interface
+  ## could not be completed.
+  ## Attributes:
+  ##     routine: the name of the routine called
+  ##     url: the URL which was being requested
+  ##     message: explanation of the problem
+  def __init__(self, routine, url, message):
+    self.routine = routine
+    self.url = url
+    self.message = message
+
+  def __str__(self):
+    return ("MoniCACommunicationError: request to %s failed in %s, %s" %
+            (self.url, self.routine, self.message))
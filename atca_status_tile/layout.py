@@ -0,0 +1,259 @@
+# coding=utf-8
+# layout.py
+# Author: Jamie Stevens
+# This file contains the routines which compile a layout written in
+# JSON into flat tables, keep the tables on disk so each layout is only
+# compiled once, and set tiles up from the tables.
+#
+# A layout looks like this:
+#   { "tiles": [
+#       { "tile": 0,
+#         "indicators": [
+#           { "foreach": { "ant": [ "ca01", "ca02" ], "col": [ 2, 3 ] },
+#             "points": "{ant}.servo.State",
+#             "accessor": "getValue",
+#             "rule": "tile_observing.antennaTracking",
+#             "x": [ "{col}" ], "y": [ 3 ] } ] } ] }
+# Each indicator reads one point, or a list of them (when "points" is a
+# list, the colour rule gets a list of values), with the named
+# MoniCAPoint accessor; "arguments" are passed on to the accessor, and
+# "series" (with "interval" and "startTime") makes the points time
+# series. The rule is the colour function, as module.function. An
+# indicator with "foreach" is repeated for each position in the lists
+# it gives, and its strings are formatted with the values there;
+# pixel coordinates given as strings are formatted then made numbers.
+
+from .errors import ArgumentError, PixelError
+from .monica_point import MoniCAPoint
+from .status_indicator import StatusIndicator
+from .status_tile import xy2pix
+from functools import partial
+import hashlib
+import importlib
+import json
+import marshal
+import os
+
+## Compiled layouts that don't have this version are compiled again.
+LAYOUT_VERSION = 1
+
+## The accessors an indicator can use.
+LAYOUT_ACCESSORS = [ "getValue", "getErrorState", "getSeries",
+                     "getBinnedSeries", "isStale" ]
+
+def expandIndicator(spec=None):
+  ## The indicator once for each position in its foreach lists, with
+  ## the strings formatted.
+  if "foreach" not in spec:
+    return [ spec ]
+  names = list(spec['foreach'].keys())
+  lengths = set([ len(spec['foreach'][n]) for n in names ])
+  if len(lengths) > 1:
+    raise ArgumentError(routine="expandIndicator", arg="foreach",
+                        message="all the lists must be the same length")
+  rv = []
+  for i in range(0, min(lengths) if len(lengths) > 0 else 0):
+    values = { n: spec['foreach'][n][i] for n in names }
+    rv.append({ k: formatValue(spec[k], values)
+                for k in spec if k != "foreach" })
+  return rv
+
+def formatValue(value=None, values={}):
+  if isinstance(value, str):
+    return value.format(**values)
+  if isinstance(value, list):
+    return [ formatValue(v, values) for v in value ]
+  if isinstance(value, dict):
+    return { k: formatValue(value[k], values) for k in value }
+  return value
+
+def compileLayout(description=None):
+  ## Turn the layout description into flat tables:
+  ##   points: ( pointName, isTimeSeries, startTime, interval )
+  ##   rules, accessors: the colour functions and the accessors (with
+  ##     their arguments) the indicators use
+  ##   indicators: ( tileNumber, rule, accessor, isList, first point,
+  ##     end point, first pixel, end pixel ), where the points and
+  ##     pixels are ranges of indicatorPoints and pixels
+  ##   pointIndicators: the indicators reading each point
+  ## All the pixels are checked here, so they needn't be again.
+  points = []
+  pointIds = {}
+  rules = []
+  accessors = []
+  indicators = []
+  indicatorPoints = []
+  pixels = []
+  tileNumbers = []
+  for tileSpec in description['tiles']:
+    tileNumber = int(tileSpec['tile'])
+    if tileNumber in tileNumbers:
+      raise ArgumentError(routine="compileLayout", arg="tile",
+                          message="tile %d is laid out twice" % tileNumber)
+    tileNumbers.append(tileNumber)
+    used = 0
+    for spec in tileSpec['indicators']:
+      for ind in expandIndicator(spec):
+        names = ind['points']
+        isList = isinstance(names, list)
+        if not isList:
+          names = [ names ]
+        isTimeSeries = ("series" in ind)
+        startTime = None
+        interval = None
+        if isTimeSeries:
+          startTime = ind['series'].get("startTime", -1)
+          interval = ind['series'].get("interval")
+        accessor = ind.get("accessor", "getValue")
+        if accessor not in LAYOUT_ACCESSORS:
+          raise ArgumentError(routine="compileLayout", arg="accessor",
+                              message="must be one of %s" %
+                              ", ".join(LAYOUT_ACCESSORS))
+        accessorKey = ( accessor,
+                        tuple(sorted(ind.get("arguments", {}).items())) )
+        if accessorKey not in accessors:
+          accessors.append(accessorKey)
+        if ind['rule'] not in rules:
+          rules.append(ind['rule'])
+        pointStart = len(indicatorPoints)
+        for name in names:
+          key = ( name, isTimeSeries )
+          if key not in pointIds:
+            pointIds[key] = len(points)
+            points.append(( name, isTimeSeries, startTime, interval ))
+          indicatorPoints.append(pointIds[key])
+        x = [ int(v) for v in ind['x'] ]
+        y = [ int(v) for v in ind['y'] ]
+        if len(x) == 0 or len(x) != len(y):
+          raise ArgumentError(routine="compileLayout", arg="x/y",
+                              message="must be equal length lists of "
+                              "pixel coordinates")
+        pixelStart = len(pixels)
+        for i in range(0, len(x)):
+          if x[i] < 0 or x[i] > 7 or y[i] < 0 or y[i] > 7:
+            raise PixelError(routine="compileLayout", x=x[i], y=y[i],
+                             message="pixel value out of range 0 <= v < 8")
+          p = xy2pix(x[i], y[i])
+          if used & (1 << p):
+            raise PixelError(routine="compileLayout", x=x[i], y=y[i],
+                             message="pixel already allocated to another "
+                             "indicator")
+          used |= (1 << p)
+          pixels.append(p)
+        indicators.append(( tileNumber, rules.index(ind['rule']),
+                            accessors.index(accessorKey), isList,
+                            pointStart, len(indicatorPoints),
+                            pixelStart, len(pixels) ))
+  pointIndicators = [ [] for p in points ]
+  for i in range(0, len(indicators)):
+    for j in range(indicators[i][4], indicators[i][5]):
+      if i not in pointIndicators[indicatorPoints[j]]:
+        pointIndicators[indicatorPoints[j]].append(i)
+  return { "version": LAYOUT_VERSION, "points": points, "rules": rules,
+           "accessors": accessors, "indicators": indicators,
+           "indicatorPoints": indicatorPoints, "pixels": pixels,
+           "pointIndicators": pointIndicators,
+           "tiles": sorted(tileNumbers) }
+
+def defaultCacheDirectory():
+  return os.path.join(os.path.expanduser("~"), ".cache", "atca_status_tile")
+
+def loadLayout(fileName=None, cacheDirectory=None):
+  ## Read the layout file and return its compiled tables, from the
+  ## cache if this content has been compiled before. The cache is
+  ## only a convenience, so if it can't be written we carry on.
+  with open(fileName, "rb") as f:
+    content = f.read()
+  contentHash = hashlib.sha256(content).hexdigest()
+  if cacheDirectory is None:
+    cacheDirectory = defaultCacheDirectory()
+  cacheName = os.path.join(cacheDirectory, "layout-%s.marshal" % contentHash)
+  try:
+    with open(cacheName, "rb") as f:
+      compiled = marshal.loads(f.read())
+    if (isinstance(compiled, dict) and
+        compiled.get("version") == LAYOUT_VERSION and
+        compiled.get("hash") == contentHash):
+      return compiled
+  except (OSError, EOFError, ValueError, TypeError):
+    pass
+  compiled = compileLayout(json.loads(content.decode("utf-8")))
+  compiled['hash'] = contentHash
+  try:
+    os.makedirs(cacheDirectory, exist_ok=True)
+    tmpName = cacheName + ".tmp"
+    with open(tmpName, "wb") as f:
+      f.write(marshal.dumps(compiled))
+    os.replace(tmpName, cacheName)
+  except OSError:
+    pass
+  return compiled
+
+def resolveRule(rule=None):
+  ## The colour function called module.function.
+  ( moduleName, functionName ) = rule.rsplit(".", 1)
+  return getattr(importlib.import_module(moduleName), functionName)
+
+def applyTileLayout(tile=None, monica=None, layout=None, tileNumber=None):
+  ## Put the indicators the layout has for the tile number on the
+  ## StatusTile. Each point gets one MoniCAPoint, however many
+  ## indicators read it.
+  indicatorCount = len(tile.indicators)
+  rules = {}
+  monicaPoints = {}
+  for ind in layout['indicators']:
+    if ind[0] != tileNumber:
+      continue
+    ( ruleId, accessorId, isList ) = ind[1:4]
+    if ruleId not in rules:
+      rules[ruleId] = resolveRule(layout['rules'][ruleId])
+    ( accessor, arguments ) = layout['accessors'][accessorId]
+    computeFunctions = []
+    for j in range(ind[4], ind[5]):
+      pointId = layout['indicatorPoints'][j]
+      if pointId not in monicaPoints:
+        ( pointName, isTimeSeries, startTime,
+          interval ) = layout['points'][pointId]
+        monicaPoints[pointId] = MoniCAPoint(
+          pointName=pointName, monicaServer=monica,
+          isTimeSeries=isTimeSeries, startTime=startTime, interval=interval)
+      f = getattr(monicaPoints[pointId], accessor)
+      if len(arguments) > 0:
+        f = partial(f, **dict(arguments))
+      computeFunctions.append(f)
+    if isList == False:
+      computeFunctions = computeFunctions[0]
+    tile.addIndicatorPixels(
+      indicator=StatusIndicator(computeFunction=computeFunctions,
+                                colourFunction=rules[ruleId]),
+      pixels=layout['pixels'][ind[6]:ind[7]])
+  ## The TileMaster can tell which points the tile reads from the
+  ## table, as long as the tile only has the layout's indicators.
+  if indicatorCount == 0:
+    tile.layoutPoints = tilePoints(layout, tileNumber)
+    tile.layoutIndicatorCount = len(tile.indicators)
+  return tile
+
+def tilePoints(layout=None, tileNumber=None):
+  ## The points read by the indicators on the tile number, as
+  ## ( pointName, isTimeSeries ).
+  rv = []
+  for pointId in range(0, len(layout['points'])):
+    for i in layout['pointIndicators'][pointId]:
+      if layout['indicators'][i][0] == tileNumber:
+        rv.append(( layout['points'][pointId][0],
+                    layout['points'][pointId][1] ))
+        break
+  return rv
+
+def layoutFunctions(layout=None):
+  ## The layout as a list of tile functions, one for each tile along
+  ## the chain (None for tiles it doesn't use), as a TileFleet wants.
+  rv = []
+  for tileNumber in range(0, max(layout['tiles']) + 1):
+    if tileNumber in layout['tiles']:
+      rv.append(partial(applyTileLayout, layout=layout,
+                        tileNumber=tileNumber))
+    else:
+      rv.append(None)
+  return rv
@@ -0,0 +1,226 @@
+# coding=utf-8
+# metrics.py
+# Author: Jamie Stevens
+# This file contains the Metrics class, which keeps counters and timing
+# histograms (labelled, for example, by tile and indicator) for the
+# busy parts of the code. They can be served as Prometheus text or
+# summarised in a periodic log line. Metrics are off until enabled,
+# and while they are off each recording call returns straight away.
+
+from .scheduler import sharedScheduler
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+import bisect
+import threading
+
+## The upper edges (in seconds) of the histogram buckets.
+DEFAULT_BUCKETS = [ 0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+                    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                    0.5, 1, 2.5, 5, 10 ]
+
+class Histogram:
+  def __init__(self, buckets=DEFAULT_BUCKETS):
+    self.buckets = buckets
+    ## The last count is for everything beyond the last bucket.
+    self.counts = [ 0 ] * (len(buckets) + 1)
+    self.count = 0
+    self.sum = 0.
+
+  def observe(self, value=0):
+    self.counts[bisect.bisect_left(self.buckets, value)] += 1
+    self.count += 1
+    self.sum += value
+
+  def quantile(self, fraction=0.5):
+    ## An estimate of the quantile: the upper edge of the bucket it
+    ## falls in, or None if there's nothing to go on.
+    if self.count == 0:
+      return None
+    target = fraction * self.count
+    total = 0
+    for i in range(0, len(self.buckets)):
+      total += self.counts[i]
+      if total >= target:
+        return self.buckets[i]
+    return float("inf")
+
+def labelKey(labels=None):
+  if labels is None:
+    return ()
+  return tuple(sorted([ ( k, str(labels[k]) ) for k in labels ]))
+
+def labelText(key=()):
+  if len(key) == 0:
+    return ""
+  return "{%s}" % ",".join([
+    '%s="%s"' % (k, v.replace("\\", "\\\\").replace('"', '\\"'))
+    for ( k, v ) in key ])
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+  def do_GET(self):
+    if self.path.split("?")[0] not in [ "/", "/metrics" ]:
+      self.send_error(404)
+      return
+    body = self.server.metrics.exportPrometheus().encode("utf-8")
+    self.send_response(200)
+    self.send_header("Content-Type", "text/plain; version=0.0.4")
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    return
+
+class Metrics:
+  def __init__(self, prefix="atca_status_tile"):
+    ## Each metric name is exported with this in front of it.
+    self.prefix = prefix
+    self.enabled = False
+    self.lock = threading.Lock()
+    self.counters = {}
+    self.histograms = {}
+    self.httpServer = None
+    self.logJob = None
+
+  def enable(self):
+    self.enabled = True
+    return self
+
+  def disable(self):
+    self.enabled = False
+    return self
+
+  def reset(self):
+    with self.lock:
+      self.counters = {}
+      self.histograms = {}
+    return self
+
+  def count(self, name=None, value=1, labels=None):
+    ## Add the value to a counter.
+    if self.enabled == False:
+      return
+    key = ( name, labelKey(labels) )
+    with self.lock:
+      self.counters[key] = self.counters.get(key, 0) + value
+
+  def observe(self, name=None, value=0, labels=None):
+    ## Add a value (usually a time in seconds) to a histogram.
+    if self.enabled == False:
+      return
+    key = ( name, labelKey(labels) )
+    with self.lock:
+      if key not in self.histograms:
+        self.histograms[key] = Histogram()
+      self.histograms[key].observe(value)
+
+  def startTimer(self):
+    ## The time to give stopTimer, or None if we aren't recording.
+    if self.enabled == False:
+      return None
+    return perf_counter()
+
+  def stopTimer(self, name=None, startTime=None, labels=None):
+    ## Record the time since startTimer in a histogram.
+    if startTime is None:
+      return
+    self.observe(name, perf_counter() - startTime, labels)
+
+  def exportPrometheus(self):
+    ## Everything we've recorded, in the Prometheus text format.
+    lines = []
+    with self.lock:
+      counters = sorted(self.counters.items())
+      histograms = sorted([ ( k, h.buckets, list(h.counts), h.count, h.sum )
+                            for ( k, h ) in self.histograms.items() ])
+    lastName = None
+    for ( ( name, key ), value ) in counters:
+      fullName = "%s_%s_total" % (self.prefix, name)
+      if name != lastName:
+        lines.append("# TYPE %s counter" % fullName)
+        lastName = name
+      lines.append("%s%s %s" % (fullName, labelText(key), repr(value)))
+    lastName = None
+    for ( ( name, key ), buckets, counts, count, total ) in histograms:
+      fullName = "%s_%s" % (self.prefix, name)
+      if name != lastName:
+        lines.append("# TYPE %s histogram" % fullName)
+        lastName = name
+      cumulative = 0
+      for i in range(0, len(buckets)):
+        cumulative += counts[i]
+        lines.append("%s_bucket%s %d" % (
+          fullName, labelText(key + (( "le", repr(buckets[i]) ),)),
+          cumulative))
+      lines.append("%s_bucket%s %d" % (
+        fullName, labelText(key + (( "le", "+Inf" ),)), count))
+      lines.append("%s_sum%s %s" % (fullName, labelText(key), repr(total)))
+      lines.append("%s_count%s %d" % (fullName, labelText(key), count))
+    return "\n".join(lines) + "\n"
+
+  def summaryLine(self):
+    ## One line with each counter, and the count, mean and estimated
+    ## p99 (in ms) of each histogram, added up over all the labels.
+    counters = {}
+    histograms = {}
+    with self.lock:
+      for ( ( name, key ), value ) in self.counters.items():
+        counters[name] = counters.get(name, 0) + value
+      for ( ( name, key ), h ) in self.histograms.items():
+        if name not in histograms:
+          histograms[name] = Histogram(h.buckets)
+        merged = histograms[name]
+        merged.counts = [ a + b for ( a, b ) in zip(merged.counts, h.counts) ]
+        merged.count += h.count
+        merged.sum += h.sum
+    parts = [ "%s=%s" % (name, counters[name]) for name in sorted(counters) ]
+    for name in sorted(histograms):
+      h = histograms[name]
+      if h.count == 0:
+        continue
+      parts.append("%s=%d/%.3fms/p99<%.3fms" % (
+        name, h.count, 1000 * h.sum / h.count, 1000 * h.quantile(0.99)))
+    return "metrics: " + " ".join(parts)
+
+  def serve(self, host="127.0.0.1", port=9464):
+    ## Serve the Prometheus text at http://host:port/metrics, and turn
+    ## the metrics on. Returns the port we ended up on.
+    self.enable()
+    if self.httpServer is None:
+      self.httpServer = ThreadingHTTPServer(( host, port ),
+                                            MetricsRequestHandler)
+      self.httpServer.daemon_threads = True
+      self.httpServer.metrics = self
+      threading.Thread(target=self.httpServer.serve_forever,
+                       daemon=True).start()
+    return self.httpServer.server_address[1]
+
+  def stopServing(self):
+    if self.httpServer is not None:
+      self.httpServer.shutdown()
+      self.httpServer.server_close()
+      self.httpServer = None
+    return self
+
+  def logPeriodically(self, interval=60, logFunction=print):
+    ## Call the log function with the summary line every interval
+    ## seconds, and turn the metrics on.
+    self.enable()
+    if self.logJob is not None:
+      self.logJob.cancel()
+    self.logJob = sharedScheduler().schedule(
+      interval=interval, function=lambda: logFunction(self.summaryLine()),
+      background=True)
+    return self
+
+  def stopLogging(self):
+    if self.logJob is not None:
+      self.logJob.cancel()
+      self.logJob = None
+    return self
+
+## The metrics everything records to.
+sharedMetricsInstance = Metrics()
+
+def metrics():
+  return sharedMetricsInstance
@@ -3,14 +3,23 @@
 # Author: Jamie Stevens
 # This is a connection to a MoniCA server.
 
-from requests import Session
+from .monica_transport import monicaTransport, monicaAsyncTransport
+from .errors import MoniCACommunicationError, NotFoundError
+from .series_buffer import seriesBuffer
+from .snapshot import saveSnapshot, loadSnapshot
+from .metrics import metrics
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from time import perf_counter, monotonic
+from fnmatch import fnmatchcase
+import asyncio
+import threading
+import traceback
 import requests
 import json
 
 class monicaPoint:
   def __init__(self, info={}):
     self.value = None
-    self.timeValue = None
     self.description = None
     self.pointName = None
     self.updateTime = None
@@ -18,6 +27,24 @@ class monicaPoint:
     self.timeSeries = False
     self.startTime = None
     self.interval = None
+    ## The samples of a time series are kept in here.
+    self.series = None
+    ## Whether the next intervals response only has the samples after
+    ## the ones we have, and how many polls since we got them all.
+    self.fetchingIncrement = False
+    self.pollsSinceResync = 0
+    ## A stale point has values from a snapshot, not from MoniCA.
+    self.stale = False
+    ## Whether the last update changed the value or error state, and
+    ## not just the time.
+    self.valueChanged = False
+    ## How often (in seconds) the point is fetched; None is every
+    ## update. If there is a minimum period, the period drops to it
+    ## when the value changes, and backs off again when it doesn't.
+    self.pollPeriod = None
+    self.minPollPeriod = None
+    self.currentPollPeriod = None
+    self.nextPollTime = None
     if "value" in info:
       self.setValue(info['value'])
     if "description" in info:
@@ -37,6 +64,49 @@ class monicaPoint:
 
   def getPointName(self):
     return self.pointName
+
+  def setPollPeriod(self, period=None, minPeriod=None):
+    self.pollPeriod = period
+    self.minPollPeriod = minPeriod
+    if minPeriod is not None:
+      self.currentPollPeriod = minPeriod
+    else:
+      self.currentPollPeriod = period
+    self.nextPollTime = None
+    return self
+
+  def getPollPeriod(self):
+    ## The period the point is being fetched at right now.
+    return self.currentPollPeriod
+
+  def isDue(self, now=None, tolerance=0):
+    if self.currentPollPeriod is None or self.nextPollTime is None:
+      return True
+    return (now >= (self.nextPollTime - tolerance))
+
+  def scheduleNextPoll(self, now=None):
+    if self.currentPollPeriod is not None:
+      self.nextPollTime = now + self.currentPollPeriod
+    return self
+
+  def adaptPollPeriod(self, changed=False, polledTime=None):
+    ## Fetch a changing point more often, and a steady one less often.
+    if self.minPollPeriod is None or self.pollPeriod is None:
+      return self
+    if changed == True:
+      self.currentPollPeriod = self.minPollPeriod
+    else:
+      self.currentPollPeriod = min(self.pollPeriod,
+                                   2 * self.currentPollPeriod)
+    self.nextPollTime = polledTime + self.currentPollPeriod
+    return self
+
+  def setStale(self, stale=False):
+    self.stale = (stale == True)
+    return self
+
+  def isStale(self):
+    return self.stale
           
   def setValue(self, value=None):
     if value is not None:
@@ -48,18 +118,66 @@ class monicaPoint:
       return self.value
     else:
       ## We can return just the latest value.
-      return self.value[-1]
+      return self.series.getSample(-1)[1]
 
   def setSeries(self, values=None):
-    ## Fill this in when we know how to do this.
-    self.timeValue = [ a[0] for a in values ]
-    self.value = [ a[1] for a in values ]
-    self.errorState = [ a[2] for a in values ]
+    if self.series is None:
+      self.series = seriesBuffer(max(len(values), 1024))
+    self.series.replace(values)
     return self
-  
+
+  def updateValue(self, value=None, updateTime=None, errorState=None):
+    ## Set the value, time and error state together, and return
+    ## whether any of them are different from what we had.
+    self.valueChanged = ((value is not None and value != self.value) or
+                         (errorState is not None and
+                          errorState != self.errorState) or
+                         self.stale)
+    changed = (self.valueChanged or
+               (updateTime is not None and updateTime != self.updateTime))
+    self.stale = False
+    self.setValue(value)
+    self.setUpdateTime(updateTime)
+    self.setErrorState(errorState)
+    return changed
+
+  def updateSeries(self, values=None):
+    ## Set the series, and return whether it is different from what
+    ## we had; the samples are in time order, so it is enough to look
+    ## at how many there are and the ends.
+    if self.stale == True:
+      self.stale = False
+      self.setSeries(values)
+      return True
+    if self.series is None or len(self.series) == 0:
+      self.setSeries(values)
+      return (len(self.series) > 0)
+    count = len(self.series)
+    first = self.series.getSample(0)
+    last = self.series.getSample(-1)
+    self.setSeries(values)
+    if len(self.series) != count:
+      return True
+    if len(self.series) == 0:
+      return False
+    return (self.series.getSample(0) != first or
+            self.series.getSample(-1) != last)
+
   def getSeries(self):
-    return { "times": self.timeValue, "values": self.value,
-             "errorStates": self.errorState }
+    if self.series is None:
+      return { "times": [], "values": [], "errorStates": [] }
+    return { "times": self.series.getTimes(),
+             "values": self.series.getValues(),
+             "errorStates": self.series.getErrorStates() }
+
+  def getSeriesBuffer(self):
+    return self.series
+
+  def getBinnedSeries(self, nbins=1, statistic="max", newestFirst=False):
+    ## The series reduced to nbins values, see seriesBuffer.bins.
+    if self.series is None:
+      return [ None ] * nbins
+    return self.series.bins(nbins, statistic, newestFirst)
 
   def setDescription(self, description=None):
     if description is not None:
@@ -87,7 +205,7 @@ class monicaPoint:
       return self.errorState
     else:
       ## We can return just the last value.
-      return self.errorState[-1]
+      return self.series.getSample(-1)[2]
 
   def setTimeSeries(self, isTimeSeries=False):
     if (isTimeSeries == True):
@@ -104,7 +222,9 @@ class monicaPoint:
       if startTime < 0:
         ## Latest data.
         self.startTime = -1
-      ## Later, we will add a way to get historical time.
+      else:
+        ## An absolute time, in the same units as the sample times.
+        self.startTime = startTime
     return self
   
   def getStartTime(self):
@@ -112,6 +232,26 @@ class monicaPoint:
       return "-1"
     return self.startTime
 
+  def getLastSampleTime(self):
+    ## The time of the newest sample we hold, or None if we have none.
+    if self.series is None or len(self.series) == 0:
+      return None
+    return self.series.getSample(-1)[0]
+
+  def mergeSeries(self, values=None):
+    ## Add the new samples to the series, and drop the samples that
+    ## have fallen out of the interval. Returns whether anything
+    ## changed.
+    if self.series is None:
+      return self.updateSeries(values)
+    added = self.series.merge(values)
+    removed = 0
+    if self.interval is not None and len(self.series) > 0:
+      ## The interval is in minutes, the times in milliseconds.
+      removed = self.series.discardUpTo(
+        self.series.getSample(-1)[0] - self.interval * 60000)
+    return (added > 0 or removed > 0)
+
   def setInterval(self, interval=None):
     if interval is not None:
       ## Interval is in minutes.
@@ -122,13 +262,81 @@ class monicaPoint:
   def getInterval(self):
     return self.interval
 
+class frozenMonicaPoint(monicaPoint):
+  ## A copy of a monicaPoint as it was at one moment. It is never
+  ## changed after it is made, so it can be read from any thread
+  ## without locking.
+  def __init__(self, point=None):
+    monicaPoint.__init__(self, {})
+    self.pointName = point.pointName
+    self.description = point.description
+    self.timeSeries = point.timeSeries
+    self.value = point.value
+    self.updateTime = point.updateTime
+    self.errorState = point.errorState
+    self.startTime = point.startTime
+    self.interval = point.interval
+    self.stale = point.stale
+    if point.series is not None:
+      self.series = point.series.copy()
+
+class registrySnapshot:
+  ## The frozen points of a monicaServer's registry, keyed by
+  ## (pointName, isTimeSeries). The generation goes up by one with
+  ## each snapshot the server publishes.
+  def __init__(self, points={}, generation=0):
+    self.points = points
+    self.generation = generation
+
+  def getGeneration(self):
+    return self.generation
+
+  def getPointByName(self, pointName=None):
+    return self.points.get(( pointName, False ))
+
+  def getTimeSeriesByName(self, pointName=None):
+    return self.points.get(( pointName, True ))
+
 class monicaServer:
   def __init__(self, info={}):
     self.serverName = "monhost-nar"
     self.protocol = "https"
     self.webserverName = "www.narrabri.atnf.csiro.au"
     self.webserverPath = "cgi-bin/obstools/web_monica/monicainterface_json.pl"
-    self.points = []
+    ## The registry of points, keyed by (pointName, isTimeSeries).
+    self.points = {}
+    self.pointReferences = {}
+    ## The poller changes the points in the registry; everyone else
+    ## reads them from the last snapshot it published. Adding or
+    ## removing points only marks the snapshot as out of date, and a
+    ## new one is published when it's next needed.
+    self.snapshot = registrySnapshot()
+    self.snapshotDirty = False
+    self.transport = None
+    self.asyncTransport = None
+    ## How many requests can be in flight at once.
+    self.maxConcurrentRequests = 4
+    self.executor = None
+    ## If set, no request asks for more than this many points.
+    self.shardSize = None
+    ## How often (in polls) each series gets its whole interval again,
+    ## rather than just the new samples; None means every time. Asking
+    ## for the new samples sends the time of the last one we have as
+    ## the start time, which has only been tried against the stand-in,
+    ## so it has to be asked for.
+    self.seriesResyncPolls = None
+    ## The polling periods, as ( pattern, period, minPeriod ), and how
+    ## early (in seconds) a point can be fetched before it is due.
+    self.pollPeriods = []
+    self.pollTolerance = 0.5
+    self.lastTimings = {}
+    self.changeListeners = []
+    self.lastChanged = set()
+    ## Where and how often (in seconds) to save the registry, so we can
+    ## start up with the last known values.
+    self.snapshotFile = None
+    self.snapshotInterval = 60
+    self.lastSnapshotTime = None
     if "serverName" in info:
       self.serverName = info['serverName']
     if "protocol" in info:
@@ -137,15 +345,70 @@ class monicaServer:
       self.webserverName = info['webserverName']
     if "webserverPath" in info:
       self.webserverPath = info['webserverPath']
+    if "shardSize" in info:
+      self.shardSize = info['shardSize']
+    if "snapshotFile" in info:
+      self.snapshotFile = info['snapshotFile']
+    if "snapshotInterval" in info:
+      self.snapshotInterval = info['snapshotInterval']
+    if "pollTolerance" in info:
+      self.pollTolerance = info['pollTolerance']
+    if "seriesResyncPolls" in info:
+      self.seriesResyncPolls = info['seriesResyncPolls']
+    if "maxConcurrentRequests" in info:
+      self.maxConcurrentRequests = info['maxConcurrentRequests']
+    ## Our own pooled transports get any settings we've been given.
+    transportInfo = {}
+    for k in [ "connectTimeout", "readTimeout", "retries",
+               "backoffFactor", "poolSize" ]:
+      if k in info:
+        transportInfo[k] = info[k]
+    if "transport" in info:
+      ## Any object with a post(url, data) method that returns the
+      ## response text can be used to talk to the web server.
+      self.transport = info['transport']
+    else:
+      self.transport = monicaTransport(transportInfo)
+    if "asyncTransport" in info:
+      ## And for the async methods, any object with a coroutine
+      ## postAsync(url, data) that returns the response text.
+      self.asyncTransport = info['asyncTransport']
+    else:
+      self.asyncTransport = monicaAsyncTransport(transportInfo)
+
+  def getTransport(self):
+    return self.transport
+
+  def getAsyncTransport(self):
+    return self.asyncTransport
+
+  def getUrl(self):
+    return self.protocol + "://" + self.webserverName + "/" + self.webserverPath
 
   def addPoint(self, pointName=None, isTimeSeries=False,
                startTime=None, interval=None):
     if pointName is not None:
-      npoint = monicaPoint({ 'pointName': pointName,
-                             'isTimeSeries': isTimeSeries,
-                             'startTime': startTime,
-                             'interval': interval })
-      self.points.append(npoint)
+      ## Each point is only stored once, however many times it
+      ## is asked for; we just count the extra requests.
+      key = ( pointName, (isTimeSeries == True) )
+      if key in self.points:
+        self.pointReferences[key] += 1
+        if key[1] == True:
+          ## Make sure the series covers the longest interval asked for.
+          series = self.points[key]
+          if (interval is not None and
+              (series.getInterval() is None or
+               interval > series.getInterval())):
+            series.setInterval(interval)
+      else:
+        npoint = monicaPoint({ 'pointName': pointName,
+                               'isTimeSeries': isTimeSeries,
+                               'startTime': startTime,
+                               'interval': interval })
+        self.points[key] = npoint
+        self.pointReferences[key] = 1
+        self.__assignPollPeriod(npoint)
+        self.snapshotDirty = True
     return self
   
   def addPoints(self, points=[]):
@@ -156,96 +419,694 @@ class monicaServer:
 
   def addTimeSeries(self, pointName=None, interval=None, startTime=None):
     if pointName is not None and interval is not None:
-      print("adding time series for %s" % pointName)
-      nseries = monicaPoint({ 'pointName': pointName,
-                              'interval': interval,
-                              'startTime': startTime,
-                              'isTimeSeries': True })
-      self.points.append(nseries)
+      self.addPoint(pointName=pointName, isTimeSeries=True,
+                    startTime=startTime, interval=interval)
+    return self
+
+  def removePoint(self, pointName=None, isTimeSeries=False):
+    ## Drop one reference to a point, and forget about the point
+    ## altogether when nobody wants it any more.
+    key = ( pointName, (isTimeSeries == True) )
+    if key in self.points:
+      self.pointReferences[key] -= 1
+      if self.pointReferences[key] <= 0:
+        del self.points[key]
+        del self.pointReferences[key]
+        self.snapshotDirty = True
+    return self
+
+  def setPollPeriod(self, pattern="*", period=None, minPeriod=None):
+    ## Fetch the points with names matching the pattern (as for
+    ## fnmatch) every period seconds; None means every update. With a
+    ## minimum period, the period adapts to how much the point changes.
+    ## The last pattern to match a point decides its period.
+    self.pollPeriods.append(( pattern, period, minPeriod ))
+    for point in self.points.values():
+      if fnmatchcase(point.getPointName(), pattern):
+        point.setPollPeriod(period, minPeriod)
     return self
+
+  def __assignPollPeriod(self, point=None):
+    for ( pattern, period, minPeriod ) in self.pollPeriods:
+      if fnmatchcase(point.getPointName(), pattern):
+        point.setPollPeriod(period, minPeriod)
+
+  def getNextPollTime(self):
+    ## The monotonic time at which the next point is due, or None if
+    ## a point is due every update.
+    nextTime = None
+    for point in self.points.values():
+      if point.getPollPeriod() is None or point.nextPollTime is None:
+        return None
+      if nextTime is None or point.nextPollTime < nextTime:
+        nextTime = point.nextPollTime
+    return nextTime
+
+  def getReferenceCount(self, pointName=None, isTimeSeries=False):
+    key = ( pointName, (isTimeSeries == True) )
+    if key in self.pointReferences:
+      return self.pointReferences[key]
+    return 0
   
   def getPointByName(self, pointName=None):
-    if pointName is not None:
-      for i in range(0, len(self.points)):
-        if (self.points[i].getPointName() == pointName and
-            self.points[i].isTimeSeries() == False):
-          return self.points[i]
-    return None
+    return self.points.get(( pointName, False ))
 
   def getTimeSeriesByName(self, pointName=None):
-    if pointName is not None:
-      for i in range(0, len(self.points)):
-        if (self.points[i].getPointName() == pointName and
-            self.points[i].isTimeSeries() == True):
-          return self.points[i]
-    return None
+    return self.points.get(( pointName, True ))
+
+  def getSnapshot(self):
+    ## The last published snapshot of the registry. It never changes,
+    ## so it can be read while the next update is being made.
+    if self.snapshotDirty == True:
+      self.publishSnapshot(set())
+    return self.snapshot
+
+  def publishSnapshot(self, changed=None):
+    ## Freeze the registry into a new snapshot and swap it in. Points
+    ## not in the changed set share their frozen copy with the last
+    ## snapshot; with no changed set every point is copied.
+    self.snapshotDirty = False
+    previous = self.snapshot.points
+    points = {}
+    for ( key, point ) in list(self.points.items()):
+      if changed is not None and key not in changed and key in previous:
+        points[key] = previous[key]
+      else:
+        points[key] = frozenMonicaPoint(point)
+    self.snapshot = registrySnapshot(points, self.snapshot.getGeneration() + 1)
+    return self.snapshot
   
   def __comms(self, data=None):
+    ## Send the request and return the text of the response.
+    if data is None:
+      return None
+
+    try:
+      return self.transport.post(url=self.getUrl(), data=data)
+    except requests.exceptions.RequestException:
+      metrics().count("monica_request_errors",
+                      labels={ "action": data['action'] })
+      return None
+
+  async def __commsAsync(self, data=None):
     if data is None:
       return None
 
-    session = Session()
-    url = self.protocol + "://" + self.webserverName + "/" + self.webserverPath
     try:
-      postResponse = session.post( url=url, data=data )
-    except requests.exceptions.ConnectionError:
-      print ("WHY YOU NO CONNECT?")
+      return await self.asyncTransport.postAsync(url=self.getUrl(),
+                                                 data=data)
+    except MoniCACommunicationError:
+      metrics().count("monica_request_errors",
+                      labels={ "action": data['action'] })
+      return None
+
+  def __decode(self, responseText=None):
+    if responseText is None:
       return None
     try:
-      rinfo = json.loads(postResponse.text)
+      rinfo = json.loads(responseText)
     except json.decoder.JSONDecodeError:
-      print ("Response from MoniCA not JSON this time")
+      ## MoniCA sometimes gives us something that isn't JSON.
+      metrics().count("monica_decode_errors")
       rinfo = None
     return rinfo
 
-  def updatePoints(self):
+  def __timedComms(self, data=None):
+    ## Run a request, and time (in seconds) how long it took to get
+    ## the response and how long to decode it.
+    startTime = perf_counter()
+    responseText = self.__comms(data)
+    decodeTime = perf_counter()
+    response = self.__decode(responseText)
+    return ( data['action'], response, decodeTime - startTime,
+             perf_counter() - decodeTime )
+
+  async def __timedCommsAsync(self, data=None):
+    startTime = perf_counter()
+    responseText = await self.__commsAsync(data)
+    decodeTime = perf_counter()
+    response = self.__decode(responseText)
+    return ( data['action'], response, decodeTime - startTime,
+             perf_counter() - decodeTime )
+
+  def __recordTimings(self, timings=None, action=None, httpTime=0,
+                      decodeTime=0, applyTime=0):
+    ## Each action's time is its slowest request, as is the time for
+    ## the http stage, since the requests run at the same time. The
+    ## decode and apply stages are added up over all the responses.
+    timings[action] = max(httpTime + decodeTime, timings.get(action, 0))
+    timings['http'] = max(httpTime, timings['http'])
+    timings['decode'] += decodeTime
+    timings['apply'] += applyTime
+    m = metrics()
+    if m.enabled == True:
+      labels = { "action": action }
+      m.observe("monica_http_seconds", httpTime, labels)
+      m.observe("monica_decode_seconds", decodeTime, labels)
+      m.observe("monica_apply_seconds", applyTime, labels)
+
+  def __seriesStartTime(self, series=None):
+    ## A series that wants the latest data only asks for the samples
+    ## after the newest one it has, except every seriesResyncPolls
+    ## polls when it gets the whole interval again to be safe. A series
+    ## from a snapshot gets the whole interval too.
+    lastTime = series.getLastSampleTime()
+    series.pollsSinceResync += 1
+    if (series.getStartTime() != "-1" or lastTime is None or
+        series.isStale() or self.seriesResyncPolls is None or
+        series.pollsSinceResync >= self.seriesResyncPolls):
+      series.fetchingIncrement = False
+      series.pollsSinceResync = 0
+      return series.getStartTime()
+    series.fetchingIncrement = True
+    return "%d" % lastTime
+
+  def __shard(self, names=[]):
+    ## Split the names into chunks of at most shardSize names, each of
+    ## which will get its own request.
+    if len(names) == 0:
+      return []
+    if self.shardSize is None or self.shardSize < 1:
+      return [ names ]
+    return [ names[i:(i + self.shardSize)]
+             for i in range(0, len(names), self.shardSize) ]
+
+  def __buildRequests(self, now=None, polled=None):
+    ## Only the points that are due are asked for, all together. The
+    ## points asked for are added to the polled list.
     ##allPointNames = [ p.getPointName() for p in self.points ]
     allPointNames = []
     allSeriesNames = []
-    success = False
-    for i in range(0, len(self.points)):
-      if self.points[i].isTimeSeries() == False:
-        allPointNames.append(self.points[i].getPointName())
+    for point in self.points.values():
+      if point.isDue(now, self.pollTolerance) == False:
+        continue
+      point.scheduleNextPoll(now)
+      polled.append(point)
+      if point.isTimeSeries() == False:
+        allPointNames.append(point.getPointName())
       else:
         allSeriesNames.append(
-          "%s,%s,%d" % (self.points[i].getPointName(),
-                        self.points[i].getStartTime(),
-                        self.points[i].getInterval())
+          "%s,%s,%d" % (point.getPointName(),
+                        self.__seriesStartTime(point),
+                        point.getInterval())
           )
+    requestList = []
+    for ( action, names ) in [ ( "points", allPointNames ),
+                               ( "intervals", allSeriesNames ) ]:
+      for shard in self.__shard(names):
+        requestList.append({ 'action': action, 'server': self.serverName,
+                             'points': ";".join(shard) })
+    return requestList
 
-    ## Start by getting just the regular point data.
-    data = { 'action': "points", 'server': self.serverName,
-             'points': ";".join(allPointNames) }
-    response = self.__comms(data)
-    if response is not None and "pointData" in response:
+  def __applyResponse(self, action=None, response=None, changed=None):
+    ## Put the data we got back into the points, and return whether
+    ## the response had the data we expected. The keys of any points
+    ## that changed are added to the changed set.
+    if response is None:
+      return False
+    if action == "points" and "pointData" in response:
       for i in range(0, len(response['pointData'])):
         if response['pointData'][i]['pointName'] is not None:
           point = self.getPointByName(response['pointData'][i]['pointName'])
-          point.setValue(response['pointData'][i]['value'])
-          point.setUpdateTime(response['pointData'][i]['time'])
-          point.setErrorState(not bool(response['pointData'][i]['errorState']))
-      success = True
-    ## And now get the time series data.
-    data = { 'action': "intervals", 'server': self.serverName,
-             'points': ";".join(allSeriesNames) }
-    ##print("time series")
-    ##print(data)
-    response = self.__comms(data)
-    ##print(response)
-    if response is not None and "intervalData" in response:
+          if point is None:
+            continue
+          if point.updateValue(
+              value=response['pointData'][i]['value'],
+              updateTime=response['pointData'][i]['time'],
+              errorState=(not bool(response['pointData'][i]['errorState']))):
+            changed.add(( point.getPointName(), False ))
+      return True
+    if action == "intervals" and "intervalData" in response:
       for i in range(0, len(response['intervalData'])):
         if response['intervalData'][i]['name'] is not None:
           series = self.getTimeSeriesByName(response['intervalData'][i]['name'])
-          point.setSeries(response['intervalData'][i]['data'])
-      success = True
+          if series is None:
+            continue
+          if series.fetchingIncrement == True:
+            seriesChanged = series.mergeSeries(
+              response['intervalData'][i]['data'])
+          else:
+            seriesChanged = series.updateSeries(
+              response['intervalData'][i]['data'])
+          if seriesChanged:
+            changed.add(( series.getPointName(), True ))
+      return True
+    return False
+
+  def getExecutor(self):
+    if self.executor is None:
+      self.executor = ThreadPoolExecutor(max_workers=self.maxConcurrentRequests)
+    return self.executor
+
+  def updatePoints(self):
+    ## All the requests (regular point data and the time series data,
+    ## in shards if we've been asked to) are sent at the same time, and
+    ## the responses are applied here as they come back.
+    startTime = perf_counter()
+    pollTime = monotonic()
+    timings = { 'http': 0., 'decode': 0., 'apply': 0. }
+    changed = set()
+    polled = []
+    executor = self.getExecutor()
+    requestList = self.__buildRequests(pollTime, polled)
+    ## Nothing has gone wrong if nothing was due.
+    success = (len(requestList) == 0)
+    futures = [ executor.submit(self.__timedComms, data)
+                for data in requestList ]
+    for future in as_completed(futures):
+      ( action, response, httpTime, decodeTime ) = future.result()
+      applyStart = perf_counter()
+      if self.__applyResponse(action, response, changed) == True:
+        success = True
+      self.__recordTimings(timings, action, httpTime, decodeTime,
+                           perf_counter() - applyStart)
+    return self.__finishUpdate(success, changed, polled, timings,
+                               startTime, pollTime)
+
+  async def updatePointsAsync(self):
+    ## The same as updatePoints, but the requests are made on the
+    ## running event loop rather than on a thread pool.
+    startTime = perf_counter()
+    pollTime = monotonic()
+    timings = { 'http': 0., 'decode': 0., 'apply': 0. }
+    changed = set()
+    polled = []
+    requestList = self.__buildRequests(pollTime, polled)
+    success = (len(requestList) == 0)
+    tasks = [ self.__timedCommsAsync(data) for data in requestList ]
+    for task in asyncio.as_completed(tasks):
+      ( action, response, httpTime, decodeTime ) = await task
+      applyStart = perf_counter()
+      if self.__applyResponse(action, response, changed) == True:
+        success = True
+      self.__recordTimings(timings, action, httpTime, decodeTime,
+                           perf_counter() - applyStart)
+    return self.__finishUpdate(success, changed, polled, timings,
+                               startTime, pollTime)
+
+  def __finishUpdate(self, success=False, changed=None, polled=[],
+                     timings={}, startTime=None, pollTime=None):
+    ## What's done after each update, however the requests were made.
+    timings['total'] = perf_counter() - startTime
+    self.lastTimings = timings
+    m = metrics()
+    if m.enabled == True:
+      m.count("monica_polls")
+      m.count("monica_points_changed", len(changed))
+      m.observe("monica_poll_seconds", timings['total'])
+    ## MoniCA gives each sample a new time, so only a new value (or a
+    ## new sample for a series) counts as the point changing here.
+    for point in polled:
+      pointChanged = (( point.getPointName(), point.isTimeSeries() )
+                      in changed)
+      if point.isTimeSeries() == False:
+        pointChanged = (pointChanged and point.valueChanged)
+      point.adaptPollPeriod(pointChanged, pollTime)
+    if len(changed) > 0 or self.snapshotDirty == True:
+      self.publishSnapshot(changed)
+    self.__notifyChanges(changed)
+    if success == True:
+      self.__periodicSnapshot()
     return success
 
+  def addChangeListener(self, listener=None):
+    ## The listener is called after each update with the set of keys
+    ## (pointName, isTimeSeries) of the points that changed; it isn't
+    ## called if nothing changed.
+    if listener is not None and listener not in self.changeListeners:
+      self.changeListeners.append(listener)
+    return self
+
+  def removeChangeListener(self, listener=None):
+    if listener in self.changeListeners:
+      self.changeListeners.remove(listener)
+    return self
+
+  def getChangedPoints(self):
+    ## The keys of the points that changed in the last update.
+    return self.lastChanged
+
+  def __notifyChanges(self, changed=None):
+    self.lastChanged = changed
+    if len(changed) > 0:
+      for listener in list(self.changeListeners):
+        listener(changed)
+
+  def saveSnapshot(self, fileName=None):
+    ## Save the registry to disk; by default to our snapshot file.
+    if fileName is None:
+      fileName = self.snapshotFile
+    if fileName is None:
+      return 0
+    self.lastSnapshotTime = monotonic()
+    return saveSnapshot(self, fileName)
+
+  def loadSnapshot(self, fileName=None):
+    ## Fill the points that have been added with their values from the
+    ## snapshot, marked as stale until MoniCA gives us fresh values.
+    if fileName is None:
+      fileName = self.snapshotFile
+    if fileName is None:
+      return 0
+    nloaded = loadSnapshot(self, fileName)
+    if nloaded > 0 or self.snapshotDirty == True:
+      self.publishSnapshot()
+    return nloaded
+
+  def __periodicSnapshot(self):
+    if self.snapshotFile is None:
+      return
+    if (self.lastSnapshotTime is None or
+        (monotonic() - self.lastSnapshotTime) >= self.snapshotInterval):
+      try:
+        self.saveSnapshot()
+      except OSError:
+        ## We'll try again at the next poll.
+        metrics().count("snapshot_save_errors")
+
+  def getTimings(self):
+    ## How long each type of request of the last update took, in
+    ## seconds. When sharding, this is the time of the slowest shard.
+    ## The http, decode and apply entries break the update into its
+    ## stages (see __recordTimings), and total is the whole update.
+    return self.lastTimings
+
+  def close(self):
+    if self.executor is not None:
+      self.executor.shutdown(wait=False)
+      self.executor = None
+    if self.transport is not None and hasattr(self.transport, "close"):
+      self.transport.close()
+    if (self.asyncTransport is not None and
+        hasattr(self.asyncTransport, "close")):
+      self.asyncTransport.close()
+    return self
+
+class monicaServerGroup:
+  ## A number of monicaServers, each with its own transport, timeouts
+  ## and statistics, which look like one server to the MoniCAPoints.
+  ## Each point is sent to one server, chosen by an explicit route for
+  ## its name, or else the longest matching name prefix, or else the
+  ## default server. Routes only affect points added after them.
+  def __init__(self, info={}):
+    self.servers = {}
+    self.defaultServer = None
+    self.prefixRoutes = []
+    self.pointRoutes = {}
+    ## Which server each registered point went to.
+    self.pointServers = {}
+    self.changeListeners = []
+    self.lastChanged = set()
+    self.lock = threading.Lock()
+    self.executor = None
+    ## The poll each server is working on, if any.
+    self.polls = {}
+    ## The merged snapshot, and the server snapshot generations it
+    ## was made from.
+    self.snapshot = registrySnapshot()
+    self.snapshotGenerations = None
+    if "servers" in info:
+      for name in info['servers']:
+        self.addServer(name=name, info=info['servers'][name])
+    if "defaultServer" in info:
+      self.defaultServer = info['defaultServer']
+    if "routes" in info:
+      for prefix in info['routes']:
+        self.addRoute(prefix=prefix, serverName=info['routes'][prefix])
+    if "pointRoutes" in info:
+      for pointName in info['pointRoutes']:
+        self.routePoint(pointName=pointName,
+                        serverName=info['pointRoutes'][pointName])
+
+  def addServer(self, name=None, server=None, info={}):
+    ## Add a server, or make one from the info. The first server added
+    ## is the default, unless we're told otherwise.
+    if server is None:
+      server = monicaServer(info)
+    self.servers[name] = server
+    if self.defaultServer is None:
+      self.defaultServer = name
+    return server
+
+  def getServer(self, name=None):
+    return self.servers.get(name)
+
+  def getServerNames(self):
+    return list(self.servers.keys())
+
+  def addRoute(self, prefix=None, serverName=None):
+    ## Send points with names starting with the prefix to the server.
+    self.prefixRoutes = [ r for r in self.prefixRoutes if r[0] != prefix ]
+    self.prefixRoutes.append(( prefix, serverName ))
+    self.prefixRoutes.sort(key=lambda r: len(r[0]), reverse=True)
+    return self
+
+  def routePoint(self, pointName=None, serverName=None):
+    ## Send this point to the server, whatever its prefix.
+    self.pointRoutes[pointName] = serverName
+    return self
+
+  def getServerNameFor(self, pointName=None):
+    if pointName in self.pointRoutes:
+      name = self.pointRoutes[pointName]
+    else:
+      name = self.defaultServer
+      for ( prefix, serverName ) in self.prefixRoutes:
+        if pointName.startswith(prefix):
+          name = serverName
+          break
+    if name not in self.servers:
+      raise NotFoundError(routine="monicaServerGroup.getServerNameFor",
+                          expected="server",
+                          message="no server to send %s to" % pointName)
+    return name
+
+  def getServerFor(self, pointName=None, isTimeSeries=False):
+    ## The server a registered point was sent to, or the one it would
+    ## be sent to now.
+    key = ( pointName, (isTimeSeries == True) )
+    if key in self.pointServers:
+      return self.servers[self.pointServers[key]]
+    return self.servers[self.getServerNameFor(pointName)]
+
+  def addPoint(self, pointName=None, isTimeSeries=False,
+               startTime=None, interval=None):
+    if pointName is not None:
+      key = ( pointName, (isTimeSeries == True) )
+      if key not in self.pointServers:
+        self.pointServers[key] = self.getServerNameFor(pointName)
+      self.servers[self.pointServers[key]].addPoint(
+        pointName=pointName, isTimeSeries=isTimeSeries,
+        startTime=startTime, interval=interval)
+    return self
+
+  def addPoints(self, points=[]):
+    for i in range(0, len(points)):
+      self.addPoint(points[i])
+    return self
+
+  def addTimeSeries(self, pointName=None, interval=None, startTime=None):
+    if pointName is not None and interval is not None:
+      self.addPoint(pointName=pointName, isTimeSeries=True,
+                    startTime=startTime, interval=interval)
+    return self
+
+  def removePoint(self, pointName=None, isTimeSeries=False):
+    key = ( pointName, (isTimeSeries == True) )
+    if key in self.pointServers:
+      server = self.servers[self.pointServers[key]]
+      server.removePoint(pointName=pointName, isTimeSeries=isTimeSeries)
+      if server.getReferenceCount(pointName, isTimeSeries) == 0:
+        del self.pointServers[key]
+    return self
+
+  def getReferenceCount(self, pointName=None, isTimeSeries=False):
+    return self.getServerFor(pointName, isTimeSeries).getReferenceCount(
+      pointName, isTimeSeries)
+
+  def getPointByName(self, pointName=None):
+    return self.getServerFor(pointName, False).getPointByName(pointName)
+
+  def getTimeSeriesByName(self, pointName=None):
+    return self.getServerFor(pointName, True).getTimeSeriesByName(pointName)
+
+  def getSnapshot(self):
+    ## The snapshots of all the servers merged into one. It is only
+    ## merged again when one of the servers has published a new one.
+    snapshots = [ server.getSnapshot() for server in self.servers.values() ]
+    generations = tuple([ snapshot.getGeneration() for snapshot in snapshots ])
+    merged = self.snapshot
+    if generations != self.snapshotGenerations:
+      points = {}
+      for snapshot in snapshots:
+        points.update(snapshot.points)
+      merged = registrySnapshot(points, merged.getGeneration() + 1)
+      self.snapshot = merged
+      self.snapshotGenerations = generations
+    return merged
+
+  def setPollPeriod(self, pattern="*", period=None, minPeriod=None):
+    for server in self.servers.values():
+      server.setPollPeriod(pattern=pattern, period=period,
+                           minPeriod=minPeriod)
+    return self
+
+  def getNextPollTime(self):
+    nextTime = None
+    for server in self.servers.values():
+      t = server.getNextPollTime()
+      if t is None:
+        return None
+      if nextTime is None or t < nextTime:
+        nextTime = t
+    return nextTime
+
+  def getExecutor(self):
+    if self.executor is None:
+      self.executor = ThreadPoolExecutor(
+        max_workers=max(1, len(self.servers)))
+    return self.executor
+
+  def pollServer(self, name=None):
+    ## Poll one server, and pass on its changes as soon as it's done.
+    server = self.servers[name]
+    try:
+      success = server.updatePoints()
+    except Exception:
+      ## Carry on with the other servers whatever this one does.
+      traceback.print_exc()
+      success = False
+    return self.__pollDone(name, success)
+
+  def __pollDone(self, name=None, success=True):
+    ## Count the failures of each server, so a failing one can be seen.
+    if success == False:
+      metrics().count("monica_poll_errors", labels={ "server": name })
+    self.__notifyChanges(self.servers[name].getChangedPoints())
+    return success
+
+  def updatePoints(self, timeout=None):
+    ## Poll all the servers at the same time, and wait up to timeout
+    ## seconds for them. A server that is still busy with its last
+    ## poll is left alone, and one that takes longer than the timeout
+    ## carries on by itself; its changes are passed on when it's done.
+    ## Returns whether every server that finished had success.
+    futures = []
+    executor = self.getExecutor()
+    with self.lock:
+      for name in self.servers:
+        if name in self.polls and self.polls[name].done() == False:
+          metrics().count("monica_polls_skipped", labels={ "server": name })
+          continue
+        self.polls[name] = executor.submit(self.pollServer, name)
+        futures.append(self.polls[name])
+    ( done, notDone ) = wait(futures, timeout=timeout)
+    success = True
+    for future in done:
+      if future.exception() is not None or future.result() == False:
+        success = False
+    return success
+
+  async def updatePointsAsync(self, timeout=None):
+    ## The same as updatePoints, on the running event loop. A server
+    ## still busy with its last poll (from here or updatePoints) is
+    ## left alone, and one that takes longer than the timeout carries
+    ## on by itself.
+    tasks = []
+    with self.lock:
+      for name in self.servers:
+        if name in self.polls and self.polls[name].done() == False:
+          metrics().count("monica_polls_skipped", labels={ "server": name })
+          continue
+        self.polls[name] = asyncio.ensure_future(
+          self.__pollServerAsync(name))
+        tasks.append(self.polls[name])
+    if len(tasks) == 0:
+      return True
+    ( done, notDone ) = await asyncio.wait(tasks, timeout=timeout)
+    return all([ task.result() == True for task in done ])
+
+  async def __pollServerAsync(self, name=None):
+    server = self.servers[name]
+    try:
+      success = await server.updatePointsAsync()
+    except Exception:
+      traceback.print_exc()
+      success = False
+    return self.__pollDone(name, success)
+
+  def addChangeListener(self, listener=None):
+    ## As for monicaServer, except each server's changes are passed on
+    ## separately, as soon as its poll is done.
+    if listener is not None and listener not in self.changeListeners:
+      self.changeListeners.append(listener)
+    return self
+
+  def removeChangeListener(self, listener=None):
+    if listener in self.changeListeners:
+      self.changeListeners.remove(listener)
+    return self
+
+  def getChangedPoints(self):
+    ## The keys of the points that changed in the last server poll to
+    ## finish.
+    return self.lastChanged
+
+  def __notifyChanges(self, changed=None):
+    self.lastChanged = changed
+    if len(changed) > 0:
+      for listener in list(self.changeListeners):
+        listener(changed)
+
+  def saveSnapshot(self, fileName=None):
+    ## Each server saves to its own snapshot file, or if we're given a
+    ## file name, to that name with the server name on the end.
+    nsaved = 0
+    for name in self.servers:
+      nsaved += self.servers[name].saveSnapshot(
+        None if fileName is None else "%s.%s" % (fileName, name))
+    return nsaved
+
+  def loadSnapshot(self, fileName=None):
+    nloaded = 0
+    for name in self.servers:
+      nloaded += self.servers[name].loadSnapshot(
+        None if fileName is None else "%s.%s" % (fileName, name))
+    return nloaded
+
+  def getTimings(self):
+    ## The timings of the last poll of each server, by server name.
+    return { name: self.servers[name].getTimings()
+             for name in self.servers }
+
+  def getStats(self):
+    ## The statistics of each server's transport, by server name.
+    stats = {}
+    for name in self.servers:
+      transport = self.servers[name].getTransport()
+      if hasattr(transport, "getStats"):
+        stats[name] = transport.getStats()
+    return stats
+
+  def close(self):
+    if self.executor is not None:
+      self.executor.shutdown(wait=False)
+      self.executor = None
+    for server in self.servers.values():
+      server.close()
+    return self
+
 serverInstance = None
 
-def initialiseServerInstance(*args):
+def initialiseServerInstance(info={}):
+  ## With "servers" in the info we make a monicaServerGroup, otherwise
+  ## just the one monicaServer.
   global serverInstance
   if serverInstance is None:
-    serverInstance = monicaServer()
+    if "servers" in info:
+      serverInstance = monicaServerGroup(info)
+    else:
+      serverInstance = monicaServer(info)
   return serverInstance
 
 def server():
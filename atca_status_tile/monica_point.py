@@ -9,6 +9,7 @@ class MoniCAPoint:
                isTimeSeries=False, startTime=None, interval=None):
     self.pointName = pointName
     self.monicaServer = monicaServer
+    self.isTimeSeries = isTimeSeries
     if (self.pointName is not None and
         self.monicaServer is not None):
       if (isTimeSeries == False):
@@ -18,21 +19,52 @@ class MoniCAPoint:
                                         interval=interval,
                                         startTime=startTime)
 
+  def getSnapshot(self, parentTile=None):
+    ## The registry snapshot to read from. Everything shown during one
+    ## refresh of the tiles comes from the same snapshot.
+    cache = getattr(parentTile, "refreshCache", None)
+    if cache is None:
+      return self.monicaServer.getSnapshot()
+    key = ( "snapshot", id(self.monicaServer) )
+    if key not in cache:
+      cache[key] = self.monicaServer.getSnapshot()
+    return cache[key]
+
   def getValue(self, parentTile=None):
     if (self.pointName is not None and
         self.monicaServer is not None):
-      point = self.monicaServer.getPointByName(self.pointName)
+      point = self.getSnapshot(parentTile).getPointByName(self.pointName)
       return point.getValue()
 
   def getSeries(self, parentTile=None):
     if (self.pointName is not None and
         self.monicaServer is not None):
-      series = self.monicaServer.getTimeSeriesByName(self.pointName)
+      series = self.getSnapshot(parentTile).getTimeSeriesByName(self.pointName)
       return series.getSeries()
+
+  def getBinnedSeries(self, parentTile=None, nbins=1, statistic="max",
+                      newestFirst=False):
+    ## The series reduced to a number of bins, which is usually all an
+    ## indicator needs to draw.
+    if (self.pointName is not None and
+        self.monicaServer is not None):
+      series = self.getSnapshot(parentTile).getTimeSeriesByName(self.pointName)
+      return series.getBinnedSeries(nbins=nbins, statistic=statistic,
+                                    newestFirst=newestFirst)
     
   def getErrorState(self, parentTile=None):
     if (self.pointName is not None and
         self.monicaServer is not None):
-      point = self.monicaServer.getPointByName(self.pointName)
+      point = self.getSnapshot(parentTile).getPointByName(self.pointName)
       return point.getErrorState()
-  
+
+  def isStale(self, parentTile=None):
+    ## Whether the value is only from a snapshot so far.
+    if (self.pointName is not None and
+        self.monicaServer is not None):
+      if (self.isTimeSeries == False):
+        point = self.getSnapshot(parentTile).getPointByName(self.pointName)
+      else:
+        point = self.getSnapshot(parentTile).getTimeSeriesByName(self.pointName)
+      return point.isStale()
+    return False
@@ -0,0 +1,246 @@
+# coding=utf-8
+# monica_standin.py
+# Author: Jamie Stevens
+# This file contains a local stand-in for the monicainterface_json.pl
+# script on the Narrabri web server. It answers the same "points" and
+# "intervals" actions with made-up data, so the MoniCA machinery can be
+# exercised and benchmarked without a network connection.
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+from time import sleep, time
+import asyncio
+import threading
+import json
+import random
+
+class monicaStandInHandler(BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1"
+  ## Send each response as soon as it's written, otherwise keep-alive
+  ## clients can sit waiting for a delayed ACK.
+  disable_nagle_algorithm = True
+
+  def do_POST(self):
+    length = int(self.headers.get("Content-Length", 0))
+    query = parse_qs(self.rfile.read(length).decode("utf-8"))
+    form = {}
+    for k in query:
+      form[k] = query[k][0]
+    body = json.dumps(self.server.standIn.respond(form)).encode("utf-8")
+    self.send_response(200)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    ## Keep quiet, we don't want a line for every request.
+    return
+
+class monicaStandIn:
+  def __init__(self, info={}):
+    self.host = "127.0.0.1"
+    ## A port of 0 means we take whatever the system gives us.
+    self.port = 0
+    self.webserverPath = "cgi-bin/obstools/web_monica/monicainterface_json.pl"
+    ## An extra delay (in seconds) added to each response.
+    self.latency = 0
+    ## How far apart (in seconds) the samples of a series are.
+    self.samplePeriod = 60
+    ## The fraction of the made-up values that change with each
+    ## response; None has them all change once a second instead.
+    self.churn = None
+    ## How many made-up points getPointNames gives.
+    self.pointCount = 200
+    self.values = {}
+    self.churnValues = {}
+    self.random = random.Random(0)
+    self.requestCount = 0
+    self.countLock = threading.Lock()
+    self.httpServer = None
+    self.thread = None
+    if "host" in info:
+      self.host = info['host']
+    if "port" in info:
+      self.port = info['port']
+    if "webserverPath" in info:
+      self.webserverPath = info['webserverPath']
+    if "latency" in info:
+      self.latency = info['latency']
+    if "samplePeriod" in info:
+      self.samplePeriod = info['samplePeriod']
+    if "churn" in info:
+      self.churn = info['churn']
+    if "pointCount" in info:
+      self.pointCount = info['pointCount']
+
+  def setValue(self, pointName=None, value=None):
+    ## Fix the value that will be returned for a point.
+    if pointName is not None:
+      self.values[pointName] = value
+    return self
+
+  def getPointNames(self, prefix="synthetic.point"):
+    ## Names for pointCount made-up points; any name can be asked for,
+    ## these are just a convenient set.
+    return [ "%s%05d" % (prefix, i) for i in range(0, self.pointCount) ]
+
+  def getValue(self, pointName=None):
+    if pointName in self.values:
+      return self.values[pointName]
+    if self.churn is not None:
+      ## The point keeps its value unless it is one of the churn
+      ## fraction that change this time.
+      if (pointName not in self.churnValues or
+          self.random.random() < self.churn):
+        self.churnValues[pointName] = "%d" % self.random.randint(0, 99)
+      return self.churnValues[pointName]
+    ## Otherwise make something up that changes with time.
+    return "%d" % (int(time()) % 100)
+
+  def respond(self, form={}):
+    with self.countLock:
+      self.requestCount += 1
+    if self.latency > 0:
+      sleep(self.latency)
+    return self.buildResponse(form)
+
+  def buildResponse(self, form={}):
+    ## Work out what the web interface would have said.
+    if "points" not in form or "action" not in form:
+      return {}
+    names = [ n for n in form['points'].split(";") if n != "" ]
+    ## Times are given in milliseconds.
+    now = int(time() * 1000)
+    period = int(self.samplePeriod * 1000)
+    if form['action'] == "points":
+      return { "pointData": [
+        { "pointName": n, "value": self.getValue(n),
+          "time": now, "errorState": True } for n in names ] }
+    if form['action'] == "intervals":
+      intervalData = []
+      for n in names:
+        els = n.split(",")
+        ## The interval is in minutes, and we give one sample every
+        ## samplePeriod, on the period.
+        interval = int(els[2]) * 60000
+        latest = now - (now % period)
+        if els[1] == "-1":
+          ## The latest interval.
+          first = latest - ((interval // period) - 1) * period
+        else:
+          ## The interval after an absolute start time.
+          start = int(float(els[1]))
+          first = start + ((period - (start % period)) % period)
+          latest = min(latest, start + interval)
+        data = [ [ t, self.getValue(els[0]), True ]
+                 for t in range(first, latest + 1, period) ]
+        intervalData.append({ "name": els[0], "data": data })
+      return { "intervalData": intervalData }
+    return {}
+
+  def start(self):
+    if self.httpServer is None:
+      self.httpServer = ThreadingHTTPServer((self.host, self.port),
+                                            monicaStandInHandler)
+      self.httpServer.daemon_threads = True
+      self.httpServer.standIn = self
+      self.port = self.httpServer.server_address[1]
+      self.thread = threading.Thread(target=self.httpServer.serve_forever,
+                                     daemon=True)
+      self.thread.start()
+    return self
+
+  def stop(self):
+    if self.httpServer is not None:
+      self.httpServer.shutdown()
+      self.httpServer.server_close()
+      self.httpServer = None
+      self.thread = None
+    return self
+
+  def getServerInfo(self):
+    ## The settings a monicaServer needs to talk to us.
+    return { "protocol": "http",
+             "webserverName": "%s:%d" % (self.host, self.port),
+             "webserverPath": self.webserverPath }
+
+class monicaAsyncStandIn(monicaStandIn):
+  ## The same stand-in, but served from an asyncio event loop so it can
+  ## share the loop with the code being tested.
+  def __init__(self, info={}):
+    monicaStandIn.__init__(self, info)
+    self.asyncServer = None
+    self.handlers = set()
+
+  async def handleConnection(self, reader, writer):
+    ## Answer requests on this connection until the client goes away.
+    self.handlers.add(asyncio.current_task())
+    try:
+      while(True):
+        requestLine = await reader.readline()
+        if len(requestLine) == 0:
+          break
+        headers = {}
+        while(True):
+          line = (await reader.readline()).decode("latin-1").strip()
+          if line == "":
+            break
+          ( name, value ) = line.split(":", 1)
+          headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length", 0))
+        query = parse_qs((await reader.readexactly(length)).decode("utf-8"))
+        form = {}
+        for k in query:
+          form[k] = query[k][0]
+        with self.countLock:
+          self.requestCount += 1
+        if self.latency > 0:
+          await asyncio.sleep(self.latency)
+        body = json.dumps(self.buildResponse(form)).encode("utf-8")
+        writer.write(("HTTP/1.1 200 OK\r\n"
+                      "Content-Type: application/json\r\n"
+                      "Content-Length: %d\r\n"
+                      "\r\n" % len(body)).encode("latin-1") + body)
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError,
+            asyncio.CancelledError):
+      ## Being cancelled just means we're being stopped, and this is
+      ## the top of the connection's task, so we finish quietly.
+      pass
+    finally:
+      self.handlers.discard(asyncio.current_task())
+      writer.close()
+
+  async def startAsync(self):
+    if self.asyncServer is None:
+      self.asyncServer = await asyncio.start_server(
+        self.handleConnection, self.host, self.port)
+      self.port = self.asyncServer.sockets[0].getsockname()[1]
+    return self
+
+  async def stopAsync(self):
+    if self.asyncServer is not None:
+      self.asyncServer.close()
+      ## Don't wait for idle keep-alive clients to hang up.
+      handlers = list(self.handlers)
+      for handler in handlers:
+        handler.cancel()
+      await asyncio.gather(*handlers, return_exceptions=True)
+      await self.asyncServer.wait_closed()
+      self.asyncServer = None
+    return self
+
+def main():
+  standIn = monicaStandIn({ "port": 8080 }).start()
+  info = standIn.getServerInfo()
+  print("MoniCA stand-in listening at %s://%s/%s" %
+        (info['protocol'], info['webserverName'], info['webserverPath']))
+  try:
+    while(True):
+      sleep(1)
+  finally:
+    standIn.stop()
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,289 @@
+# coding=utf-8
+# monica_transport.py
+# Author: Jamie Stevens
+# This file contains the transports which carry requests between a
+# monicaServer and the MoniCA web interface. A single transport keeps
+# pooled, keep-alive connections open for its whole life, so each poll
+# doesn't have to set up new TCP and TLS connections.
+
+from .errors import MoniCACommunicationError
+from time import perf_counter
+from urllib.parse import urlsplit, urlencode
+import asyncio
+import socket
+import ssl
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+class monicaTransport:
+  def __init__(self, info={}):
+    ## Timeouts are in seconds.
+    self.connectTimeout = 5
+    self.readTimeout = 10
+    ## How many times a failed request is retried before giving up.
+    self.retries = 2
+    self.backoffFactor = 0.2
+    ## How many connections we keep open to the web server.
+    self.poolSize = 4
+    self.session = None
+    self.sessionLock = threading.Lock()
+    self.statsLock = threading.Lock()
+    self.resetStats()
+    if "connectTimeout" in info:
+      self.connectTimeout = info['connectTimeout']
+    if "readTimeout" in info:
+      self.readTimeout = info['readTimeout']
+    if "retries" in info:
+      self.retries = info['retries']
+    if "backoffFactor" in info:
+      self.backoffFactor = info['backoffFactor']
+    if "poolSize" in info:
+      self.poolSize = info['poolSize']
+
+  def getSession(self):
+    ## Make the session the first time we need it, and keep it.
+    with self.sessionLock:
+      if self.session is None:
+        ## The MoniCA queries only read data, so it is safe to retry
+        ## the POSTs as well.
+        retry = Retry(total=self.retries, connect=self.retries,
+                      read=self.retries, status=self.retries,
+                      backoff_factor=self.backoffFactor,
+                      status_forcelist=[ 502, 503, 504 ],
+                      allowed_methods=frozenset([ "GET", "POST" ]),
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=self.poolSize,
+                              max_retries=retry)
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        self.session = session
+    return self.session
+
+  def post(self, url=None, data=None):
+    ## Send the data to the URL and return the text of the response.
+    ## Any exception from requests is passed on to the caller, after
+    ## the latency has been recorded.
+    session = self.getSession()
+    startTime = perf_counter()
+    try:
+      postResponse = session.post(
+        url=url, data=data,
+        timeout=(self.connectTimeout, self.readTimeout))
+      text = postResponse.text
+    except requests.exceptions.RequestException:
+      self.recordLatency(perf_counter() - startTime, failed=True)
+      raise
+    self.recordLatency(perf_counter() - startTime)
+    return text
+
+  def recordLatency(self, latency=None, failed=False):
+    with self.statsLock:
+      self.lastLatency = latency
+      self.requestCount += 1
+      if failed == True:
+        self.failureCount += 1
+      self.totalLatency += latency
+      if self.minLatency is None or latency < self.minLatency:
+        self.minLatency = latency
+      if self.maxLatency is None or latency > self.maxLatency:
+        self.maxLatency = latency
+    return self
+
+  def resetStats(self):
+    with self.statsLock:
+      self.lastLatency = None
+      self.requestCount = 0
+      self.failureCount = 0
+      self.totalLatency = 0.
+      self.minLatency = None
+      self.maxLatency = None
+    return self
+
+  def getStats(self):
+    ## All the latencies are in seconds.
+    with self.statsLock:
+      meanLatency = None
+      if self.requestCount > 0:
+        meanLatency = self.totalLatency / self.requestCount
+      return { "requests": self.requestCount,
+               "failures": self.failureCount,
+               "lastLatency": self.lastLatency,
+               "meanLatency": meanLatency,
+               "minLatency": self.minLatency,
+               "maxLatency": self.maxLatency }
+
+  def close(self):
+    with self.sessionLock:
+      if self.session is not None:
+        self.session.close()
+        self.session = None
+    return self
+
+class monicaAsyncTransport(monicaTransport):
+  ## The same as a monicaTransport, but for use from an asyncio event
+  ## loop. The HTTP conversation is done directly on asyncio streams,
+  ## and idle keep-alive connections are kept for the next request.
+  def __init__(self, info={}):
+    monicaTransport.__init__(self, info)
+    self.idleConnections = {}
+    self.loop = None
+
+  def getSession(self):
+    ## We don't use a requests session.
+    return None
+
+  async def openConnection(self, scheme=None, host=None, port=None):
+    sslContext = None
+    serverHostname = None
+    if scheme == "https":
+      sslContext = ssl.create_default_context()
+      serverHostname = host
+    return await asyncio.wait_for(
+      asyncio.open_connection(host, port, ssl=sslContext,
+                              server_hostname=serverHostname),
+      self.connectTimeout)
+
+  def getIdleConnection(self, key=None):
+    ## Connections belong to the loop that made them, so we can't
+    ## keep using them if the loop has changed.
+    loop = asyncio.get_running_loop()
+    if self.loop is not loop:
+      self.closeIdleConnections()
+      self.loop = loop
+    if key in self.idleConnections and len(self.idleConnections[key]) > 0:
+      return self.idleConnections[key].pop()
+    return None
+
+  def putIdleConnection(self, key=None, connection=None):
+    if key not in self.idleConnections:
+      self.idleConnections[key] = []
+    if len(self.idleConnections[key]) < self.poolSize:
+      self.idleConnections[key].append(connection)
+    else:
+      connection[1].close()
+    return self
+
+  async def readResponse(self, reader=None):
+    ## Returns the status, whether the connection can be used again,
+    ## and the body text.
+    statusLine = await reader.readline()
+    if len(statusLine) == 0:
+      raise ConnectionError("connection closed by server")
+    els = statusLine.decode("latin-1").split(None, 2)
+    status = int(els[1])
+    headers = {}
+    while(True):
+      line = await reader.readline()
+      if len(line) == 0:
+        raise ConnectionError("connection closed in headers")
+      line = line.decode("latin-1").strip()
+      if line == "":
+        break
+      ( name, value ) = line.split(":", 1)
+      headers[name.strip().lower()] = value.strip()
+    keepAlive = True
+    if ("connection" in headers and
+        headers['connection'].lower() == "close"):
+      keepAlive = False
+    if ("transfer-encoding" in headers and
+        headers['transfer-encoding'].lower() == "chunked"):
+      body = b""
+      while(True):
+        size = int((await reader.readline()).split(b";")[0], 16)
+        if size == 0:
+          await reader.readline()
+          break
+        body += await reader.readexactly(size)
+        await reader.readline()
+    elif "content-length" in headers:
+      body = await reader.readexactly(int(headers['content-length']))
+    else:
+      body = await reader.read()
+      keepAlive = False
+    return ( status, keepAlive, body.decode("utf-8") )
+
+  async def postOnce(self, url=None, data=None):
+    parts = urlsplit(url)
+    port = parts.port
+    if port is None:
+      port = 443 if parts.scheme == "https" else 80
+    key = ( parts.scheme, parts.hostname, port )
+    path = parts.path
+    if parts.query != "":
+      path += "?" + parts.query
+    body = urlencode(data).encode("utf-8")
+    request = ("POST %s HTTP/1.1\r\n"
+               "Host: %s\r\n"
+               "Content-Type: application/x-www-form-urlencoded\r\n"
+               "Content-Length: %d\r\n"
+               "Connection: keep-alive\r\n"
+               "\r\n" % (path, parts.netloc, len(body))).encode("latin-1")
+    connection = self.getIdleConnection(key)
+    if connection is None:
+      connection = await self.openConnection(parts.scheme, parts.hostname,
+                                             port)
+    ( reader, writer ) = connection
+    try:
+      writer.write(request + body)
+      await writer.drain()
+      ( status, keepAlive, text ) = await asyncio.wait_for(
+        self.readResponse(reader), self.readTimeout)
+    except BaseException:
+      writer.close()
+      raise
+    if keepAlive == True:
+      self.putIdleConnection(key, connection)
+    else:
+      writer.close()
+    return ( status, text )
+
+  async def postAsync(self, url=None, data=None):
+    ## Send the data to the URL and return the text of the response,
+    ## retrying with a backoff if the request fails.
+    startTime = perf_counter()
+    attempt = 0
+    while(True):
+      try:
+        ( status, text ) = await self.postOnce(url, data)
+        if status not in [ 502, 503, 504 ] or attempt >= self.retries:
+          break
+      except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError,
+              ValueError) as e:
+        if attempt >= self.retries:
+          self.recordLatency(perf_counter() - startTime, failed=True)
+          raise MoniCACommunicationError(
+            routine="monicaAsyncTransport.postAsync", url=url,
+            message="%s after %d attempts" % (repr(e), attempt + 1))
+      await asyncio.sleep(self.backoffFactor * (2 ** attempt))
+      attempt += 1
+    self.recordLatency(perf_counter() - startTime)
+    return text
+
+  def closeConnection(self, connection=None):
+    ## A connection can only be closed properly on the loop that made
+    ## it; if that loop has been closed, we just shut the socket down.
+    writer = connection[1]
+    if self.loop is not None and self.loop.is_closed():
+      sock = writer.get_extra_info("socket")
+      if sock is not None:
+        try:
+          sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+          pass
+      return self
+    writer.close()
+    return self
+
+  def closeIdleConnections(self):
+    for key in self.idleConnections:
+      for connection in self.idleConnections[key]:
+        self.closeConnection(connection)
+    self.idleConnections = {}
+    return self
+
+  def close(self):
+    return self.closeIdleConnections()
@@ -3,31 +3,38 @@
 # Author: Jamie Stevens
 # This file contains the RepeatedTimer class which allows the TileMaster
 # to periodically and automatically call refresh on all the indicators.
+# The calls are made by the shared Scheduler, so there is no new thread
+# for each tick.
 
-from threading import Timer
+from .scheduler import sharedScheduler
 
 class RepeatedTimer(object):
   def __init__(self, interval, function, *args, **kwargs):
-    self._timer = None
+    self._job = None
     self.interval = interval
     self.function = function
     self.args = args
     self.kwargs = kwargs
     self.is_running = False
+    self.scheduler = sharedScheduler()
     self.start()
 
-  def _run(self):
-    self.is_running = False
-    self.start()
-    self.function(*self.args, **self.kwargs)
-
   def start(self):
     if not self.is_running:
-      self._timer = Timer(self.interval, self._run)
-      self._timer.start()
+      self._job = self.scheduler.schedule(interval=self.interval,
+                                          function=self.function,
+                                          args=self.args,
+                                          kwargs=self.kwargs)
       self.is_running = True
 
   def stop(self):
-    self._timer.cancel()
+    if self._job is not None:
+      self._job.cancel()
     self.is_running = False
+
+  def getStats(self):
+    ## The jitter and overrun statistics of the scheduled job.
+    if self._job is None:
+      return None
+    return self._job.getStats()
     
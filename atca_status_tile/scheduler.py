@@ -0,0 +1,212 @@
+# coding=utf-8
+# scheduler.py
+# Author: Jamie Stevens
+# This file contains the Scheduler class, which runs all the periodic
+# jobs (refreshing tiles, test patterns and so on) from a single thread.
+# Deadlines are kept on the monotonic clock so the jobs don't drift, and
+# ticks that are missed are skipped rather than run late.
+
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+import heapq
+import itertools
+import threading
+import traceback
+
+class ScheduledJob:
+  def __init__(self, scheduler=None, interval=None, function=None,
+               args=(), kwargs={}, allowOverlap=False, background=False):
+    self.scheduler = scheduler
+    ## The period in seconds, or None for a job that runs once.
+    self.interval = interval
+    self.function = function
+    self.args = args
+    self.kwargs = kwargs
+    ## Background jobs run on the scheduler's worker threads, so they
+    ## can't hold up the other jobs; unless overlaps are allowed, a tick
+    ## is skipped if the last run hasn't finished.
+    self.allowOverlap = allowOverlap
+    self.background = background
+    self.deadline = None
+    self.cancelled = False
+    self.runningCount = 0
+    self.statsLock = threading.Lock()
+    self.resetStats()
+
+  def resetStats(self):
+    with self.statsLock:
+      self.runs = 0
+      self.errors = 0
+      self.missedTicks = 0
+      self.overlapsSkipped = 0
+      self.overruns = 0
+      self.totalJitter = 0.
+      self.maxJitter = 0.
+      self.lastRunTime = None
+      self.maxRunTime = 0.
+    return self
+
+  def getStats(self):
+    ## Jitter is how late (in seconds) each run started, and an overrun
+    ## is a run that took longer than the interval.
+    with self.statsLock:
+      meanJitter = None
+      if self.runs > 0:
+        meanJitter = self.totalJitter / self.runs
+      return { "runs": self.runs, "errors": self.errors,
+               "missedTicks": self.missedTicks,
+               "overlapsSkipped": self.overlapsSkipped,
+               "overruns": self.overruns,
+               "meanJitter": meanJitter, "maxJitter": self.maxJitter,
+               "lastRunTime": self.lastRunTime,
+               "maxRunTime": self.maxRunTime }
+
+  def cancel(self):
+    self.cancelled = True
+    return self
+
+  def isActive(self):
+    return (self.cancelled == False)
+
+  def execute(self, now=None):
+    ## Called by the scheduler when the job's deadline has come.
+    jitter = now - self.deadline
+    if self.background == True:
+      with self.statsLock:
+        if self.runningCount > 0 and self.allowOverlap == False:
+          self.overlapsSkipped += 1
+          return
+        self.runningCount += 1
+      self.scheduler.getExecutor().submit(self.call, jitter)
+    else:
+      with self.statsLock:
+        self.runningCount += 1
+      self.call(jitter)
+
+  def call(self, jitter=0):
+    startTime = monotonic()
+    try:
+      self.function(*self.args, **self.kwargs)
+    except Exception:
+      ## Keep the scheduler going whatever the job does.
+      traceback.print_exc()
+      with self.statsLock:
+        self.errors += 1
+    runTime = monotonic() - startTime
+    with self.statsLock:
+      self.runningCount -= 1
+      self.runs += 1
+      self.totalJitter += jitter
+      self.maxJitter = max(self.maxJitter, jitter)
+      self.lastRunTime = runTime
+      self.maxRunTime = max(self.maxRunTime, runTime)
+      if self.interval is not None and runTime > self.interval:
+        self.overruns += 1
+
+  def advance(self, now=None):
+    ## Move the deadline on by whole intervals, past now, counting any
+    ## ticks we've missed.
+    n = int((now - self.deadline) // self.interval) + 1
+    if n < 1:
+      n = 1
+    with self.statsLock:
+      self.missedTicks += n - 1
+    self.deadline += n * self.interval
+    return self
+
+class Scheduler:
+  def __init__(self, workers=2):
+    self.workers = workers
+    self.executor = None
+    self.queue = []
+    self.sequence = itertools.count()
+    self.condition = threading.Condition()
+    self.thread = None
+    self.running = False
+
+  def start(self):
+    with self.condition:
+      if self.running == False:
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+    return self
+
+  def stop(self):
+    with self.condition:
+      self.running = False
+      self.condition.notify()
+    if (self.thread is not None and
+        self.thread is not threading.current_thread()):
+      self.thread.join()
+    self.thread = None
+    if self.executor is not None:
+      self.executor.shutdown(wait=False)
+      self.executor = None
+    return self
+
+  def getExecutor(self):
+    if self.executor is None:
+      self.executor = ThreadPoolExecutor(max_workers=self.workers)
+    return self.executor
+
+  def push(self, job=None):
+    with self.condition:
+      heapq.heappush(self.queue, ( job.deadline, next(self.sequence), job ))
+      self.condition.notify()
+
+  def schedule(self, interval=None, function=None, args=(), kwargs={},
+               allowOverlap=False, background=False, startDelay=None):
+    ## Run the function every interval seconds, first after startDelay
+    ## seconds (the interval if not given).
+    job = ScheduledJob(scheduler=self, interval=interval, function=function,
+                       args=args, kwargs=kwargs, allowOverlap=allowOverlap,
+                       background=background)
+    if startDelay is None:
+      startDelay = interval
+    job.deadline = monotonic() + startDelay
+    self.push(job)
+    self.start()
+    return job
+
+  def scheduleOnce(self, delay=0, function=None, args=(), kwargs={}):
+    ## Run the function once, after delay seconds.
+    job = ScheduledJob(scheduler=self, interval=None, function=function,
+                       args=args, kwargs=kwargs)
+    job.deadline = monotonic() + delay
+    self.push(job)
+    self.start()
+    return job
+
+  def run(self):
+    while(True):
+      with self.condition:
+        job = None
+        while self.running == True and job is None:
+          if len(self.queue) == 0:
+            self.condition.wait()
+            continue
+          wait = self.queue[0][0] - monotonic()
+          if wait > 0:
+            self.condition.wait(wait)
+            continue
+          job = heapq.heappop(self.queue)[2]
+          if job.cancelled == True:
+            job = None
+        if self.running == False:
+          return
+      job.execute(monotonic())
+      if job.interval is not None and job.cancelled == False:
+        job.advance(monotonic())
+        self.push(job)
+
+## The scheduler everything shares, unless told otherwise.
+sharedSchedulerInstance = None
+sharedSchedulerLock = threading.Lock()
+
+def sharedScheduler():
+  global sharedSchedulerInstance
+  with sharedSchedulerLock:
+    if sharedSchedulerInstance is None:
+      sharedSchedulerInstance = Scheduler()
+  return sharedSchedulerInstance
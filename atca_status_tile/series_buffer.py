@@ -0,0 +1,231 @@
+# coding=utf-8
+# series_buffer.py
+# Author: Jamie Stevens
+# This file contains the seriesBuffer class, a fixed size ring buffer
+# which holds the samples of a MoniCA time series in typed columns,
+# and can reduce them to a small number of bins for display.
+
+from .errors import ArgumentError
+from array import array
+import math
+try:
+  import numpy
+except ImportError:
+  ## We can do everything with the array module, just more slowly.
+  numpy = None
+
+## The statistics a set of samples can be reduced to.
+BIN_STATISTICS = [ "min", "max", "mean", "last" ]
+
+def toFloat(value=None):
+  ## MoniCA may give us numbers or strings; anything that isn't a
+  ## number is stored as NaN.
+  try:
+    return float(value)
+  except (TypeError, ValueError):
+    return math.nan
+
+def toErrorFlag(errorState=None):
+  if errorState == True or errorState == "true" or errorState == 1:
+    return 1
+  return 0
+
+class seriesBuffer:
+  def __init__(self, capacity=1024):
+    self.capacity = 0
+    self.times = None
+    self.values = None
+    self.errorStates = None
+    ## The physical index of the oldest sample, and how many we have.
+    self.head = 0
+    self.count = 0
+    self.allocate(capacity)
+
+  def allocate(self, capacity=1024):
+    ## Make new, empty, columns.
+    self.capacity = max(1, capacity)
+    if numpy is not None:
+      self.times = numpy.zeros(self.capacity, dtype=numpy.float64)
+      self.values = numpy.zeros(self.capacity, dtype=numpy.float64)
+      self.errorStates = numpy.zeros(self.capacity, dtype=numpy.uint8)
+    else:
+      self.times = array("d", bytes(8 * self.capacity))
+      self.values = array("d", bytes(8 * self.capacity))
+      self.errorStates = array("B", bytes(self.capacity))
+    self.head = 0
+    self.count = 0
+    return self
+
+  def __len__(self):
+    return self.count
+
+  def clear(self):
+    self.head = 0
+    self.count = 0
+    return self
+
+  def append(self, time=None, value=None, errorState=None):
+    ## Add a sample to the end of the buffer, overwriting the oldest
+    ## sample if the buffer is full.
+    p = (self.head + self.count) % self.capacity
+    self.times[p] = toFloat(time)
+    self.values[p] = toFloat(value)
+    self.errorStates[p] = toErrorFlag(errorState)
+    if self.count < self.capacity:
+      self.count += 1
+    else:
+      self.head = (self.head + 1) % self.capacity
+    return self
+
+  def extend(self, samples=[]):
+    ## Each sample is a [ time, value, errorState ] list, as MoniCA
+    ## returns them.
+    for i in range(0, len(samples)):
+      self.append(*samples[i][0:3])
+    return self
+
+  def replace(self, samples=[]):
+    ## Throw away what we have and store these samples instead, making
+    ## more room first if we have to.
+    if len(samples) > self.capacity:
+      self.allocate(len(samples))
+    self.clear()
+    return self.extend(samples)
+
+  def resize(self, capacity=1024):
+    ## Change the size of the buffer, keeping the newest samples that
+    ## fit.
+    times = self.getTimes()
+    values = self.getValues()
+    errorStates = self.getErrorStates()
+    self.allocate(capacity)
+    start = max(0, len(times) - self.capacity)
+    for i in range(start, len(times)):
+      self.append(times[i], values[i], errorStates[i])
+    return self
+
+  def copy(self):
+    ## A new buffer holding just our samples, oldest first.
+    rv = seriesBuffer(self.count)
+    if self.count == 0:
+      return rv
+    if numpy is not None:
+      rv.times[:] = numpy.concatenate(self.view(self.times))
+      rv.values[:] = numpy.concatenate(self.view(self.values))
+      rv.errorStates[:] = numpy.concatenate(self.view(self.errorStates))
+    else:
+      rv.times = array("d", self.column(self.times))
+      rv.values = array("d", self.column(self.values))
+      rv.errorStates = array("B", self.column(self.errorStates))
+    rv.count = self.count
+    return rv
+
+  def merge(self, samples=[]):
+    ## Add the samples that are newer than the newest one we have,
+    ## making more room if we need to. Returns how many were added.
+    if self.count > 0:
+      lastTime = self.getSample(-1)[0]
+      samples = [ a for a in samples if toFloat(a[0]) > lastTime ]
+    if self.count + len(samples) > self.capacity:
+      self.resize(2 * (self.count + len(samples)))
+    self.extend(samples)
+    return len(samples)
+
+  def discardUpTo(self, time=None):
+    ## Forget the samples at or before the time. Returns how many were
+    ## thrown away.
+    n = 0
+    while n < self.count and self.times[(self.head + n) % self.capacity] <= time:
+      n += 1
+    self.head = (self.head + n) % self.capacity
+    self.count -= n
+    return n
+
+  def physicalIndex(self, i=0):
+    ## Turn a logical index (0 is the oldest sample, negative indices
+    ## count back from the newest) into an index into the columns.
+    if i < 0:
+      i += self.count
+    if i < 0 or i >= self.count:
+      raise IndexError("seriesBuffer index out of range")
+    return (self.head + i) % self.capacity
+
+  def getSample(self, i=-1):
+    p = self.physicalIndex(i)
+    return ( float(self.times[p]), float(self.values[p]),
+             bool(self.errorStates[p]) )
+
+  def segments(self, start=0, end=None):
+    ## The logical range [start, end) as at most two contiguous
+    ## physical ranges, so the columns can be viewed without copying.
+    if end is None:
+      end = self.count
+    if end <= start:
+      return []
+    p0 = (self.head + start) % self.capacity
+    n = end - start
+    if p0 + n <= self.capacity:
+      return [ ( p0, p0 + n ) ]
+    return [ ( p0, self.capacity ), ( 0, p0 + n - self.capacity ) ]
+
+  def view(self, column=None, start=0, end=None):
+    ## Views of the column over a logical range.
+    if numpy is not None:
+      return [ column[a:b] for ( a, b ) in self.segments(start, end) ]
+    m = memoryview(column)
+    return [ m[a:b] for ( a, b ) in self.segments(start, end) ]
+
+  def column(self, column=None):
+    ## A column as a list, oldest sample first.
+    rv = []
+    for v in self.view(column):
+      rv.extend(v.tolist())
+    return rv
+
+  def getTimes(self):
+    return self.column(self.times)
+
+  def getValues(self):
+    return self.column(self.values)
+
+  def getErrorStates(self):
+    return [ bool(e) for e in self.column(self.errorStates) ]
+
+  def reduce(self, start=0, end=None, statistic="max"):
+    ## Reduce the values in the logical range [start, end) to a single
+    ## number, or None if there are no samples.
+    views = self.view(self.values, start, end)
+    if len(views) == 0:
+      return None
+    if statistic == "last":
+      return float(views[-1][-1])
+    if numpy is not None:
+      if statistic == "min":
+        return float(min([ v.min() for v in views ]))
+      if statistic == "max":
+        return float(max([ v.max() for v in views ]))
+      if statistic == "mean":
+        return (float(sum([ v.sum() for v in views ])) /
+                sum([ len(v) for v in views ]))
+    else:
+      if statistic == "min":
+        return min([ min(v) for v in views ])
+      if statistic == "max":
+        return max([ max(v) for v in views ])
+      if statistic == "mean":
+        return sum([ sum(v) for v in views ]) / sum([ len(v) for v in views ])
+    raise ArgumentError(routine="seriesBuffer.reduce", arg="statistic",
+                        message="must be one of %s" % ", ".join(BIN_STATISTICS))
+
+  def bins(self, nbins=1, statistic="max", newestFirst=False):
+    ## Split the samples into nbins bins with (as near as possible)
+    ## the same number of samples in each, and reduce each bin. Bins
+    ## with no samples in them are None.
+    rv = []
+    for i in range(0, nbins):
+      start = (i * self.count) // nbins
+      end = ((i + 1) * self.count) // nbins
+      rv.append(self.reduce(start, end, statistic))
+    if newestFirst == True:
+      rv.reverse()
+    return rv
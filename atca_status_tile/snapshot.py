@@ -0,0 +1,78 @@
+# coding=utf-8
+# snapshot.py
+# Author: Jamie Stevens
+# This file contains the routines which save the last known values
+# of the points in a monicaServer to disk, and load them back again,
+# so the tiles have something to show straight after a restart.
+
+from array import array
+import marshal
+import os
+
+## Every snapshot file starts with this, followed by the version.
+SNAPSHOT_MAGIC = b"ATSTSNAP"
+SNAPSHOT_VERSION = 1
+
+def saveSnapshot(server=None, fileName=None):
+  ## Write the registry of the server to the file. The file is written
+  ## to a temporary name and moved into place, so a reader never sees
+  ## half a snapshot. Returns the number of points saved.
+  entries = []
+  for ( key, point ) in list(server.points.items()):
+    entry = [ key[0], key[1], point.value, point.updateTime,
+              point.errorState, None ]
+    series = point.getSeriesBuffer()
+    if key[1] == True and series is not None:
+      ## The series columns are kept as packed arrays.
+      entry[2] = None
+      entry[4] = None
+      entry[5] = ( array("d", series.getTimes()).tobytes(),
+                   array("d", series.getValues()).tobytes(),
+                   array("B", [ int(e) for e in
+                                series.getErrorStates() ]).tobytes() )
+    entries.append(tuple(entry))
+  tmpName = fileName + ".tmp"
+  with open(tmpName, "wb") as f:
+    f.write(SNAPSHOT_MAGIC)
+    f.write(marshal.dumps(( SNAPSHOT_VERSION, entries )))
+  os.replace(tmpName, fileName)
+  return len(entries)
+
+def loadSnapshot(server=None, fileName=None):
+  ## Fill in the points the server already knows about from the file,
+  ## and mark them as stale. Returns the number of points loaded, which
+  ## is 0 if there is no usable snapshot.
+  try:
+    with open(fileName, "rb") as f:
+      if f.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+        return 0
+      ( version, entries ) = marshal.loads(f.read())
+  except (OSError, EOFError, ValueError, TypeError):
+    return 0
+  if version != SNAPSHOT_VERSION:
+    return 0
+  nloaded = 0
+  for ( pointName, isTimeSeries, value, updateTime, errorState,
+        seriesColumns ) in entries:
+    if isTimeSeries == True:
+      point = server.getTimeSeriesByName(pointName)
+      if point is None or seriesColumns is None:
+        continue
+      times = array("d")
+      times.frombytes(seriesColumns[0])
+      values = array("d")
+      values.frombytes(seriesColumns[1])
+      errorStates = array("B")
+      errorStates.frombytes(seriesColumns[2])
+      point.setSeries([ [ times[i], values[i], bool(errorStates[i]) ]
+                        for i in range(0, len(times)) ])
+    else:
+      point = server.getPointByName(pointName)
+      if point is None:
+        continue
+      point.setValue(value)
+      point.setUpdateTime(updateTime)
+      point.setErrorState(errorState)
+    point.setStale(True)
+    nloaded += 1
+  return nloaded
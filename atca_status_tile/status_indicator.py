@@ -5,8 +5,55 @@
 # based on some function.
 
 from .errors import FunctionError
+from .monica_point import MoniCAPoint
+from functools import partial
 import types
 
+## Find the MoniCAPoint a compute function gets its value from, if
+## it is one of the MoniCAPoint methods (or a partial of one).
+def computeFunctionPoint(computeFunction=None):
+  while isinstance(computeFunction, partial):
+    computeFunction = computeFunction.func
+  owner = getattr(computeFunction, "__self__", None)
+  if isinstance(owner, MoniCAPoint):
+    return owner
+  return None
+
+## The key a compute function's value is cached under for one refresh:
+## the point and the accessor (with any partial arguments). Functions
+## that aren't MoniCAPoint accessors aren't cached, and get None.
+def computeFunctionKey(computeFunction=None):
+  args = ()
+  keywords = ()
+  while isinstance(computeFunction, partial):
+    args = computeFunction.args + args
+    keywords = tuple(sorted(computeFunction.keywords.items())) + keywords
+    computeFunction = computeFunction.func
+  owner = getattr(computeFunction, "__self__", None)
+  if not isinstance(owner, MoniCAPoint):
+    return None
+  key = ( id(owner.monicaServer), owner.pointName,
+          (owner.isTimeSeries == True), computeFunction.__name__,
+          args, keywords )
+  try:
+    hash(key)
+  except TypeError:
+    return None
+  return key
+
+## Call the compute function, unless its value has already been worked
+## out during this refresh of the parent tile.
+def cachedCompute(computeFunction=None, parentTile=None):
+  cache = getattr(parentTile, "refreshCache", None)
+  if cache is None:
+    return computeFunction(parentTile=parentTile)
+  key = computeFunctionKey(computeFunction)
+  if key is None:
+    return computeFunction(parentTile=parentTile)
+  if key not in cache:
+    cache[key] = computeFunction(parentTile=parentTile)
+  return cache[key]
+
 class StatusIndicator:
   def __init__(self, computeFunction=None, colourFunction=None):
     self.computeFunction = computeFunction
@@ -18,10 +65,10 @@ class StatusIndicator:
     # Work out the current state and new colour.
     if (self.computeFunction is not None and self.colourFunction is not None):
       if isinstance(self.computeFunction, list):
-        newState = list(map(lambda x: x(parentTile=parentTile),
+        newState = list(map(lambda x: cachedCompute(x, parentTile),
                             self.computeFunction))
       else:
-        newState = self.computeFunction(parentTile=parentTile)
+        newState = cachedCompute(self.computeFunction, parentTile)
       self.state = newState
 
       newColour = self.colourFunction(self.state, parentTile=parentTile)
@@ -37,4 +84,23 @@ class StatusIndicator:
 
   def getColours(self):
     return self.colour
+
+  def getPoints(self):
+    ## The MoniCAPoints that the compute functions read.
+    computeFunctions = self.computeFunction
+    if not isinstance(computeFunctions, list):
+      computeFunctions = [ computeFunctions ]
+    points = []
+    for f in computeFunctions:
+      point = computeFunctionPoint(f)
+      if point is not None:
+        points.append(point)
+    return points
+
+  def isStale(self, parentTile=None):
+    ## An indicator is stale if any of its points are.
+    for point in self.getPoints():
+      if cachedCompute(point.isStale, parentTile):
+        return True
+    return False
   
@@ -6,6 +6,14 @@
 
 from .errors import ArgumentError, PixelError
 from .repeated_timer import RepeatedTimer
+from .metrics import metrics
+from . import colours
+from functools import lru_cache
+try:
+  import numpy
+except ImportError:
+  ## Without numpy, frames are kept as lists of tuples.
+  numpy = None
 
 ## A mapper between (x,y) and pixel number.
 def xy2pix(x=0, y=0):
@@ -40,14 +48,51 @@ def rgb2hsv(r, g, b):
   ## Calculate the fractional brightness (value).
   v = cmax
   return (h, s, v)
+
+## Conversion between RGB and the hue and saturation the tiles use
+## (16-bit numbers), along with the fractional brightness. There are
+## only a few colours in use, so we remember the answers, but not too
+## many in case an indicator comes up with lots of colours.
+@lru_cache(maxsize=256)
+def rgb2hsbk(r, g, b):
+  (h, s, v) = rgb2hsv(r, g, b)
+  return ( int(round((h / 360) * 65535)), int(round(65535 * s)), v )
+
+## Start with all the colours we know by name.
+def preloadColours():
+  for colourName in dir(colours):
+    if colourName.isupper():
+      for colour in getattr(colours, colourName):
+        rgb2hsbk(*colour)
+
+preloadColours()
   
 class StatusTile:
-  def __init__(self, tile=None, tileNumber=None):
+  def __init__(self, tile=None, tileNumber=None, useArrays=None):
     self.tileMaster = tile
     self.tileNumber = tileNumber
     self.indicators = []
-    self.colours = [ ( 0, 0, 0, 0 ) ] * 64
+    ## The frame can be kept as a 64x4 array, which we use if we can.
+    if useArrays is None:
+      useArrays = (numpy is not None)
+    if useArrays == True and numpy is None:
+      raise ArgumentError(
+        routine="StatusTile.__init__",
+        arg="useArrays",
+        message="numpy is needed for array frames"
+        )
+    self.useArrays = useArrays
+    if self.useArrays == True:
+      self.colours = numpy.zeros(( 64, 4 ), dtype=numpy.uint16)
+      self.unusedPixels = numpy.arange(64)
+    else:
+      self.colours = [ ( 0, 0, 0, 0 ) ] * 64
     self.pixelsUsed = [ False ] * 64
+    ## If the tile was set up from a compiled layout, the points (keyed
+    ## as the MoniCA server keys them) it reads, and how many
+    ## indicators the layout gave it.
+    self.layoutPoints = None
+    self.layoutIndicatorCount = 0
     self.lastBrightness = 65535 ## Full brightness.
     self.lastTemperature = 3500 ## Default colour temperature.
     self.testMode = False
@@ -55,6 +100,11 @@ class StatusTile:
     self.testPixel = 0
     self.testColours = [ ( 0, 0, 0, 3500 ) ] * 64
     self.attentionRequired = False
+    ## The fraction of the normal brightness for stale indicators.
+    self.staleDimming = 0.5
+    ## The values the compute functions have given during this refresh,
+    ## so each point is only looked at once.
+    self.refreshCache = None
 
   def addIndicator(self, indicator=None, x=[], y=[]):
     p = []
@@ -86,12 +136,25 @@ class StatusTile:
           )
       p.append(tp)
     ## If we get here, this indicator can be added to our list.
+    return self.addIndicatorPixels(indicator=indicator, pixels=p)
+
+  def addIndicatorPixels(self, indicator=None, pixels=[]):
+    ## Add an indicator showing on the pixel numbers given, which must
+    ## already have been checked (as addIndicator does, or when a
+    ## layout is compiled).
+    p = list(pixels)
     self.indicators.append({
       "indicator": indicator,
       "pixels": p
       })
     for i in p:
       self.pixelsUsed[i] = True
+    if self.useArrays == True:
+      ## Keep the pixels as index arrays so each indicator can be
+      ## painted in one go.
+      self.indicators[-1]["pixelIndex"] = numpy.array(p, dtype=numpy.intp)
+      self.unusedPixels = numpy.flatnonzero(
+        numpy.logical_not(self.pixelsUsed))
     return self
 
   def callForAttention(self):
@@ -103,6 +166,29 @@ class StatusTile:
     if self.testMode == True:
       return
     #print("DEBUG: tile %d being refreshed" % self.tileNumber)
+    self.compute(brightness=brightness, temperature=temperature)
+    # Now update the tile.
+    #print ("DEBUG: tile %d colours is now:", self.tileNumber)
+    #print (self.colours)
+    self.tileMaster.setTileColours(tileNumber=self.tileNumber,
+                                   colours=self.colours)
+
+  def compute(self, brightness=None, temperature=None, refreshCache=None):
+    ## Work out the new pixel values, without sending them to the
+    ## tile. Returns the new colours, or None if we're being tested.
+    ## The refresh cache can be shared with other tiles being refreshed
+    ## at the same time.
+    if self.testMode == True:
+      return None
+    if refreshCache is None:
+      refreshCache = {}
+    self.refreshCache = refreshCache
+    try:
+      return self.computeFrame(brightness=brightness, temperature=temperature)
+    finally:
+      self.refreshCache = None
+
+  def computeFrame(self, brightness=None, temperature=None):
     ## Called to update the pixel values.
     if brightness is None:
       brightness = self.lastBrightness
@@ -114,10 +200,15 @@ class StatusTile:
       self.lastTemperature = temperature
 
     self.attentionRequired = False
+    m = metrics()
     for i in range(0, len(self.indicators)):
       ## Make a run through all the indicators first to see if they
       ## need to call for attention.
+      startTime = m.startTimer()
       self.indicators[i]["indicator"].refresh(parentTile=self)
+      if startTime is not None:
+        m.stopTimer("indicator_compute_seconds", startTime,
+                    { "tile": self.tileNumber, "indicator": i })
 
     ## Increase the brightness if attention is required.
     if (self.attentionRequired):
@@ -126,36 +217,51 @@ class StatusTile:
       brightness = 16383 ## Quarter brightness
 
     ## Now run through the indicators again and set the pixels.
+    startTime = m.startTimer()
+    freshBrightness = brightness
     for i in range(0, len(self.indicators)):
+      ## Indicators showing values from a snapshot are dimmed until
+      ## MoniCA gives us something fresh.
+      brightness = freshBrightness
+      if self.indicators[i]["indicator"].isStale(parentTile=self):
+        brightness = freshBrightness * self.staleDimming
       pixelColours = self.indicators[i]["indicator"].getColours()
       if len(pixelColours) == 1:
         # Just one colour for all the pixels.
         # Convert RGB to HS.
-        (hue, saturation, value) = rgb2hsv(*pixelColours[0])
+        (hue, saturation, value) = rgb2hsbk(*pixelColours[0])
+        pixel = ( hue, saturation, int(brightness * value), temperature )
         # Set the pixels.
-        for j in range(len(self.indicators[i]["pixels"])):
-          self.colours[self.indicators[i]["pixels"][j]] = (
-            (hue / 360) * 65535, 65535 * saturation,
-            brightness * value, temperature )
+        if self.useArrays == True:
+          self.colours[self.indicators[i]["pixelIndex"]] = pixel
+        else:
+          for j in range(len(self.indicators[i]["pixels"])):
+            self.colours[self.indicators[i]["pixels"][j]] = pixel
       elif len(pixelColours) == len(self.indicators[i]["pixels"]):
         ## One colour per pixel, we assume they're in the
         ## same order.
+        pixels = []
         for j in range(len(self.indicators[i]["pixels"])):
-          (hue, saturation, value) = rgb2hsv(*pixelColours[j])
-          self.colours[self.indicators[i]["pixels"][j]] = (
-            (hue / 360) * 65535, 65535 * saturation,
-            brightness * value, temperature )
+          (hue, saturation, value) = rgb2hsbk(*pixelColours[j])
+          pixels.append(( hue, saturation, int(brightness * value),
+                          temperature ))
+        if self.useArrays == True:
+          self.colours[self.indicators[i]["pixelIndex"]] = pixels
+        else:
+          for j in range(len(self.indicators[i]["pixels"])):
+            self.colours[self.indicators[i]["pixels"][j]] = pixels[j]
 
     ## Blank out all the pixels that aren't used.
-    for i in range(0, len(self.pixelsUsed)):
-      if (self.pixelsUsed[i] == False):
-        self.colours[i] = ( 0, 0, 0, self.lastTemperature )
-          
-    # Now update the tile.
-    #print ("DEBUG: tile %d colours is now:", self.tileNumber)
-    #print (self.colours)
-    self.tileMaster.setTileColours(tileNumber=self.tileNumber,
-                                   colours=self.colours)
+    if self.useArrays == True:
+      self.colours[self.unusedPixels] = ( 0, 0, 0, self.lastTemperature )
+    else:
+      for i in range(0, len(self.pixelsUsed)):
+        if (self.pixelsUsed[i] == False):
+          self.colours[i] = ( 0, 0, 0, self.lastTemperature )
+    if startTime is not None:
+      m.stopTimer("colour_conversion_seconds", startTime,
+                  { "tile": self.tileNumber })
+    return self.colours
     
   def startTest(self):
     #print ("DEBUG: entering test mode for tile %d",
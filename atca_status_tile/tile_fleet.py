@@ -0,0 +1,225 @@
+# coding=utf-8
+# tile_fleet.py
+# Author: Jamie Stevens
+# This file contains the TileFleet class, which looks after a TileMaster
+# for each of several tile chains, all showing data from one
+# monicaServer. Everything that talks to the chains is done on a
+# bounded pool of worker threads, so a slow or offline chain only ever
+# holds up its own redraws, and is added whenever it does answer.
+
+from .errors import ArgumentError, NotFoundError
+from .tile_master import TileMaster
+from .scheduler import sharedScheduler
+from .metrics import metrics
+from concurrent.futures import ThreadPoolExecutor, wait
+from time import monotonic
+import threading
+import traceback
+
+class TileFleet:
+  def __init__(self, monica=None, workers=4, refreshTime=60,
+               minFrameInterval=0.25, verifyTime=None, connectTimeout=5):
+    self.monica = monica
+    ## The most chains that can be written to at the same time.
+    self.workers = workers
+    self.executor = ThreadPoolExecutor(max_workers=workers)
+    ## How often (in seconds) every chain is redrawn anyway, and the
+    ## shortest time between the redraws for changes of each chain.
+    self.refreshTime = refreshTime
+    self.minFrameInterval = minFrameInterval
+    ## How often each chain's tiles are read back to check they show
+    ## what we sent; if not given, every third refreshTime.
+    if verifyTime is None:
+      verifyTime = 3 * refreshTime
+    self.verifyTime = verifyTime
+    ## The TileMasters, by name, in the order they were added.
+    self.masters = {}
+    ## The chains we haven't managed to talk to yet, by name. Each is
+    ## tried on a worker, and addDevice waits up to connectTimeout
+    ## seconds for it; one that fails is tried again after
+    ## connectRetryTime seconds.
+    self.pendingDevices = {}
+    self.connectTimeout = connectTimeout
+    self.connectRetryTime = refreshTime
+    ## Whether the chains were last told to switch on or off, so those
+    ## that turn up late can be told too.
+    self.power = None
+    self.polled = False
+    ## The keep-alive refresh each chain is working on, if any.
+    self.refreshFutures = {}
+    self.lock = threading.Lock()
+    self.timer = None
+
+  def addDevice(self, lifxTile=None, layout=[], name=None, useArrays=None):
+    ## Add a tile chain, and set its tiles up with the layout, which is
+    ## a list of functions (as in the tile modules) called with the
+    ## StatusTile and the MoniCA server for each tile in turn; None
+    ## leaves a tile unused. Returns the chain's TileMaster, or None if
+    ## the chain hasn't answered yet; it will be added when it does.
+    if lifxTile is None:
+      raise NotFoundError(routine="TileFleet.addDevice",
+                          expected="lifxTile",
+                          message="No LiFX tileset was specified")
+    if name is None:
+      name = "%d" % (len(self.masters) + len(self.pendingDevices))
+    if name in self.masters or name in self.pendingDevices:
+      raise ArgumentError(routine="TileFleet.addDevice", arg="name",
+                          message="a device called %s is already in the "
+                          "fleet" % name)
+    with self.lock:
+      self.pendingDevices[name] = { "lifxTile": lifxTile, "layout": layout,
+                                    "useArrays": useArrays, "future": None,
+                                    "lastAttempt": None }
+    future = self.connectDevice(name)
+    wait([ future ], timeout=self.connectTimeout)
+    self.finishConnections()
+    return self.masters.get(name)
+
+  def connectDevice(self, name=None):
+    ## Start talking to a chain on one of our workers, since a chain
+    ## that is slow or offline can take a long time to answer.
+    device = self.pendingDevices[name]
+    device['lastAttempt'] = monotonic()
+    device['future'] = self.executor.submit(
+      TileMaster, lifxTile=device['lifxTile'], refreshTime=self.refreshTime,
+      autoRefresh=False, useArrays=device['useArrays'],
+      verifyTime=self.verifyTime)
+    return device['future']
+
+  def finishConnections(self):
+    ## Add the chains that have answered since we last looked, and try
+    ## again with those that failed, if they've waited long enough.
+    ## The layouts add points to the MoniCA server, so this is done
+    ## from addDevice and poll, not while the server is polling.
+    for name in list(self.pendingDevices.keys()):
+      device = self.pendingDevices[name]
+      future = device['future']
+      if future is None:
+        if (monotonic() - device['lastAttempt']) >= self.connectRetryTime:
+          self.connectDevice(name)
+        continue
+      if future.done() == False:
+        continue
+      if future.exception() is not None:
+        ## The chain may be offline; it gets another go later.
+        metrics().count("fleet_connect_errors", labels={ "device": name })
+        e = future.exception()
+        traceback.print_exception(type(e), e, e.__traceback__)
+        device['future'] = None
+        continue
+      master = future.result()
+      master.name = name
+      master.minFrameInterval = self.minFrameInterval
+      master.renderExecutor = self.executor
+      layout = device['layout']
+      for i in range(0, len(layout)):
+        if layout[i] is not None:
+          layout[i](tile=master.addTile(tileNumber=i), monica=self.monica)
+      with self.lock:
+        self.masters[name] = master
+        del self.pendingDevices[name]
+      if self.power is not None:
+        self.executor.submit(
+          master.powerOn if self.power == True else master.powerOff)
+      ## The points it shows may have been polled already, and won't
+      ## change just because it's turned up, so draw it now.
+      if self.polled == True:
+        self.refreshDevice(name, background=True)
+    return self
+
+  def getPendingDeviceNames(self):
+    ## The chains that haven't answered yet.
+    return list(self.pendingDevices.keys())
+
+  def getDevice(self, name=None):
+    return self.masters.get(name)
+
+  def getDeviceNames(self):
+    return list(self.masters.keys())
+
+  def start(self):
+    ## Redraw the chains when their points change, and every
+    ## refreshTime seconds.
+    if self.monica is not None:
+      self.monica.addChangeListener(self.pointsChanged)
+    if self.timer is None:
+      self.timer = sharedScheduler().schedule(interval=self.refreshTime,
+                                              function=self.refresh)
+    return self
+
+  def poll(self):
+    ## One poll of the MoniCA server, which redraws whatever changed on
+    ## every chain. Chains that have turned up since the last poll
+    ## are added first.
+    self.finishConnections()
+    rv = self.monica.updatePoints()
+    self.polled = True
+    return rv
+
+  def pointsChanged(self, changed=None):
+    ## Each TileMaster works out which of its tiles need redrawing,
+    ## and has the redraw done on our workers.
+    for master in list(self.masters.values()):
+      master.pointsChanged(changed)
+
+  def refresh(self):
+    ## Redraw every chain, except those still busy with the last one.
+    with self.lock:
+      for name in self.masters:
+        future = self.refreshFutures.get(name)
+        if future is not None and future.done() == False:
+          metrics().count("fleet_refreshes_skipped", labels={ "device": name })
+          continue
+        self.refreshFutures[name] = self.executor.submit(
+          self.refreshDevice, name)
+    return self
+
+  def refreshDevice(self, name=None, background=False):
+    ## Redraw one chain, here or on one of our workers.
+    if background == True:
+      with self.lock:
+        self.refreshFutures[name] = self.executor.submit(
+          self.refreshDevice, name)
+      return
+    try:
+      self.masters[name].refresh()
+    except Exception:
+      ## The chain may be offline; it gets another go next time.
+      metrics().count("fleet_device_errors", labels={ "device": name })
+      traceback.print_exc()
+
+  def callAll(self, method=None, timeout=None):
+    ## Call a TileMaster method on every chain at once, and wait up to
+    ## timeout seconds for them. Returns the names of the chains that
+    ## didn't manage it in time, or failed.
+    futures = {}
+    for name in list(self.masters.keys()):
+      futures[self.executor.submit(getattr(self.masters[name], method))] = name
+    ( done, notDone ) = wait(futures, timeout=timeout)
+    failed = [ futures[f] for f in notDone ]
+    failed += [ futures[f] for f in done if f.exception() is not None ]
+    return sorted(failed)
+
+  def powerOn(self, timeout=None):
+    self.power = True
+    return self.callAll("powerOn", timeout)
+
+  def powerOff(self, timeout=None):
+    self.power = False
+    return self.callAll("powerOff", timeout)
+
+  def getStats(self):
+    ## The write statistics of each chain.
+    return { name: self.masters[name].getWriteStats()
+             for name in list(self.masters.keys()) }
+
+  def stop(self):
+    if self.timer is not None:
+      self.timer.cancel()
+      self.timer = None
+    if self.monica is not None:
+      self.monica.removeChangeListener(self.pointsChanged)
+    for master in list(self.masters.values()):
+      master.stop()
+    self.executor.shutdown(wait=False)
+    return self
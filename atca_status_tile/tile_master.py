@@ -5,46 +5,119 @@
 # split into several StatusTiles.
 
 from .errors import NotFoundError, TileCommunicationError, ArgumentError, TileError
-from .status_tile import StatusTile
+from .status_tile import StatusTile, xy2pix
 from .repeated_timer import RepeatedTimer
+from .scheduler import sharedScheduler
+from .metrics import metrics
+from threading import Lock
+from time import monotonic
+import asyncio
+import traceback
+try:
+  import numpy
+except ImportError:
+  numpy = None
 
 class TileMaster:
-  def __init__(self, lifxTile=None, refreshTime=10):
+  def __init__(self, lifxTile=None, refreshTime=10, autoRefresh=True,
+               useArrays=None, verifyTime=None):
     self.lifxTile = lifxTile
+    ## What we're called in the metrics, if anything.
+    self.name = None
+    ## Whether the StatusTiles keep their frames in arrays; None lets
+    ## them decide.
+    self.useArrays = useArrays
     self.refreshTime = refreshTime
     self.temperature = None
     self.brightness = None
+    ## Our copy of what each tile is showing, which is the frame we
+    ## last sent it, so we only need to send changes.
     self.colours = None
     self.tiles = None
-    self.timer = RepeatedTimer(refreshTime, self.refresh)
+    ## How often (in seconds) the refresh checks our copy against the
+    ## tiles, so anything the tiles missed gets redrawn; if not given,
+    ## every third refresh.
+    if verifyTime is None:
+      verifyTime = 3 * refreshTime
+    self.verifyTime = verifyTime
+    self.lastResyncTime = None
+    ## Each pixel is sent as four 16-bit numbers.
+    self.bytesPerPixel = 8
+    ## Whether refresh sends the tiles their frames without waiting
+    ## for each to be acknowledged (only done if verifyTime is set).
+    self.pipelineCommits = True
+    self.resetWriteStats()
+    ## Only one refresh can be working on the tiles at a time.
+    self.renderLock = Lock()
+    ## For rendering when MoniCA data changes: the tiles waiting to be
+    ## redrawn, and the shortest time (in seconds) between redraws.
+    self.dirtyTiles = set()
+    self.dirtyLock = Lock()
+    self.minFrameInterval = 0.25
+    self.lastRenderTime = None
+    self.renderTimer = None
+    self.renderPending = False
+    ## Where the redraws for changes are done; None does them on the
+    ## thread that was told about the change, or the scheduler's.
+    self.renderExecutor = None
+    self.dependencies = None
+    self.dependencyCount = None
+    self.timer = None
+    ## Without the timer, refresh has to be called by the owner, or
+    ## by running the run coroutine.
+    if autoRefresh == True:
+      self.timer = RepeatedTimer(refreshTime, self.refresh)
     self.getStatus()
 
   def getStatus(self):
     #print("DEBUG: tile master getting tile status")
-    ## This gets the current values of the tile pixels.
+    ## This gets the current values of the tile pixels. We keep our
+    ## own copy of what the tiles are showing, and only ask the tiles
+    ## the first time, or when it is time to check our copy.
+    if self.colours is None or self.verificationDue():
+      self.resync()
+    return self.colours
+
+  def resync(self):
+    ## Ask the tiles what they are showing, and make that our copy.
     if self.lifxTile is not None:
-      self.colours = self.lifxTile.get_tilechain_colors()
+      startTime = metrics().startTimer()
+      colours = self.lifxTile.get_tilechain_colors()
+      metrics().stopTimer("lan_read_seconds", startTime)
     else:
-      raise NotFoundError(routine="TileMaster.getStatus",
+      raise NotFoundError(routine="TileMaster.resync",
                           expected="lifxTile",
                           message="No LiFX tileset was specified")
     ## Work out the temperature and brightness.
     ## We assume here that each pixel has the same brightness and
     ## temperature for simplicity.
-    if self.colours is not None:
-      self.temperature = self.colours[0][0][3]
-      self.brightness = self.colours[0][0][2]
+    if colours is not None:
+      self.temperature = colours[0][0][3]
+      self.brightness = colours[0][0][2]
     else:
-      raise TileCommunicationError(routine="TileMaster.getStatus",
+      raise TileCommunicationError(routine="TileMaster.resync",
                                    method="get_tilechain_colours",
                                    message="Could not get colours from tiles")
+    ## The tiles are showing what they've just told us, so this is
+    ## also what we compare new frames against.
+    self.colours = [ [ tuple(c) for c in t ] for t in colours ]
+    self.lastResyncTime = monotonic()
     ## If we're here for the first time, we initialise the
-    ## tile list.
-    self.tiles = [ None ] * len(self.colours)
+    ## tile list; after that we keep the tiles we've allocated.
+    if self.tiles is None:
+      self.tiles = [ None ] * len(self.colours)
+    elif len(self.tiles) < len(self.colours):
+      self.tiles += [ None ] * (len(self.colours) - len(self.tiles))
     return self.colours
+
+  def verificationDue(self):
+    return (self.verifyTime is not None and
+            (self.lastResyncTime is None or
+             (monotonic() - self.lastResyncTime) >= self.verifyTime))
     
   def getTileValues(self, tileNumber=None):
-    ## Return just the values for a specified tileNumber.
+    ## Return just the values for a specified tileNumber, from our
+    ## copy.
     self.getStatus()
     if tileNumber is not None and len(self.colours) > tileNumber:
       return self.colours[tileNumber]
@@ -89,22 +162,159 @@ class TileMaster:
     ## We can allocate this tile.
     #print ("DEBUG: adding tile for %d" % tileNumber)
     self.tiles[tileNumber] = StatusTile(tile=self,
-                                        tileNumber=tileNumber)
+                                        tileNumber=tileNumber,
+                                        useArrays=self.useArrays)
     return self.tiles[tileNumber]
 
   def refresh(self):
-    print ("DEBUG: TileMaster is refreshing")
+    metrics().count("refreshes")
     if self.tiles is None:
       raise NotFoundError(routine="TileMaster.refresh",
                           expected="tiles",
                           message="No tiles configured in tile set")
+    if self.verificationDue():
+      self.resync()
+    self.refreshTiles(range(0, len(self.tiles)))
+
+  def refreshTiles(self, tileNumbers=[]):
+    ## First work out what every tile should look like, and only then
+    ## send them all together, so the tiles change at the same time.
     #print ("DEBUG: TileMaster knows about %d tiles" % len(self.tiles))
-    for i in range(0, len(self.tiles)):
-      #print ("DEBUG: Checking tile %d" % i)
-      if self.tiles[i] is not None:
-        #print ("DEBUG: found a usable tile, refreshing")
-        self.tiles[i].refresh(brightness=self.brightness,
-                              temperature=self.temperature)
+    ## Each point is only looked up once however many tiles show it.
+    startTime = metrics().startTimer()
+    with self.renderLock:
+      frames = [ None ] * len(self.tiles)
+      refreshCache = {}
+      for i in tileNumbers:
+        #print ("DEBUG: Checking tile %d" % i)
+        if self.tiles[i] is not None:
+          #print ("DEBUG: found a usable tile, computing")
+          frames[i] = self.tiles[i].compute(brightness=self.brightness,
+                                            temperature=self.temperature,
+                                            refreshCache=refreshCache)
+      self.commitFrames(frames)
+      self.lastRenderTime = monotonic()
+    metrics().stopTimer("refresh_seconds", startTime)
+
+  def renderOnChange(self, monica=None, minFrameInterval=None):
+    ## Redraw the tiles that show a point as soon as the MoniCA server
+    ## tells us it has changed, but no more often than minFrameInterval
+    ## seconds; changes that come in between are drawn together. The
+    ## refresh timer carries on as a keep-alive.
+    if minFrameInterval is not None:
+      self.minFrameInterval = minFrameInterval
+    if monica is not None:
+      monica.addChangeListener(self.pointsChanged)
+    return self
+
+  def getDependencies(self):
+    ## Which tiles show each point, keyed as the MoniCA server keys its
+    ## changes. Tiles with indicators that don't say which points they
+    ## read are listed under None, and are redrawn on every change.
+    ## Tiles set up from a compiled layout come with the points they
+    ## read. This is worked out again when indicators are added.
+    count = sum([ len(t.indicators) for t in self.tiles if t is not None ])
+    if self.dependencies is None or count != self.dependencyCount:
+      dependencies = { None: set() }
+      for i in range(0, len(self.tiles)):
+        if self.tiles[i] is None:
+          continue
+        if (self.tiles[i].layoutPoints is not None and
+            len(self.tiles[i].indicators) ==
+            self.tiles[i].layoutIndicatorCount):
+          for key in self.tiles[i].layoutPoints:
+            if key not in dependencies:
+              dependencies[key] = set()
+            dependencies[key].add(i)
+          continue
+        for ind in self.tiles[i].indicators:
+          points = ind["indicator"].getPoints()
+          computeFunctions = ind["indicator"].computeFunction
+          if not isinstance(computeFunctions, list):
+            computeFunctions = [ computeFunctions ]
+          if len(points) < len(computeFunctions):
+            dependencies[None].add(i)
+          for point in points:
+            key = ( point.pointName, (point.isTimeSeries == True) )
+            if key not in dependencies:
+              dependencies[key] = set()
+            dependencies[key].add(i)
+      self.dependencies = dependencies
+      self.dependencyCount = count
+    return self.dependencies
+
+  def pointsChanged(self, changed=None):
+    ## Called by the MoniCA server with the keys of the points that
+    ## changed.
+    if self.tiles is None:
+      return
+    dependencies = self.getDependencies()
+    affected = set(dependencies[None])
+    for key in changed:
+      if key in dependencies:
+        affected.update(dependencies[key])
+    if len(affected) == 0:
+      return
+    with self.dirtyLock:
+      self.dirtyTiles.update(affected)
+      if self.renderPending == True:
+        ## A redraw is already on its way, and will draw these too.
+        return
+      self.renderPending = True
+    self.scheduleRender()
+
+  def scheduleRender(self):
+    ## Start the redraw as soon as minFrameInterval allows.
+    wait = 0
+    if self.lastRenderTime is not None:
+      wait = self.minFrameInterval - (monotonic() - self.lastRenderTime)
+    if wait > 0:
+      with self.dirtyLock:
+        self.renderTimer = sharedScheduler().scheduleOnce(
+          delay=wait, function=self.dispatchRender)
+    else:
+      self.dispatchRender()
+
+  def dispatchRender(self):
+    if self.renderExecutor is None:
+      self.renderDirty()
+    else:
+      self.renderExecutor.submit(self.renderDirty)
+
+  def renderDirty(self):
+    ## Redraw the tiles that are waiting. If more changes came in while
+    ## we were drawing, there's another redraw after this one, so there
+    ## is only ever one redraw on its way for each TileMaster.
+    with self.dirtyLock:
+      tileNumbers = sorted(self.dirtyTiles)
+      self.dirtyTiles = set()
+      self.renderTimer = None
+    try:
+      if len(tileNumbers) > 0:
+        self.refreshTiles(tileNumbers)
+    except Exception:
+      ## The tiles may be offline. The keep-alive refresh will have
+      ## another go, and the next change gets its own redraw.
+      metrics().count("render_errors", labels={ "device": self.name })
+      traceback.print_exc()
+    with self.dirtyLock:
+      if len(self.dirtyTiles) == 0 or self.renderPending == False:
+        self.renderPending = False
+        return
+    self.scheduleRender()
+
+  def commitFrames(self, frames=[]):
+    ## Send a frame to each tile that has one. When pipelining, we
+    ## don't wait for each tile to acknowledge before sending the next.
+    ## A frame that gets lost that way stays lost while our copy says
+    ## the tile has it, so we only pipeline when our copy is checked
+    ## against the tiles from time to time.
+    rapid = (self.pipelineCommits == True and self.verifyTime is not None)
+    for i in range(0, len(frames)):
+      if frames[i] is not None:
+        self.commitTileColours(tileNumber=i, colours=frames[i],
+                               rapid=rapid)
+    return self
 
   def setTileColours(self, tileNumber=None, colours=None):
     #print("DEBUG: tile colours being set by master")
@@ -122,11 +332,119 @@ class TileMaster:
                           arg="colours",
                           message="argument was not supplied or is wrong size")
     ## We can set these colours.
-    self.colours[tileNumber] = colours
+    self.commitTileColours(tileNumber=tileNumber, colours=colours)
+
+  def commitTileColours(self, tileNumber=None, colours=None, rapid=False):
+    ## Send the colours to the tile, but only the part that is
+    ## different from what we sent last time, and nothing at all if
+    ## it's the same.
+    if numpy is not None and isinstance(colours, numpy.ndarray):
+      return self.commitTileArray(tileNumber=tileNumber, colours=colours,
+                                  rapid=rapid)
+    frame = [ tuple(c) for c in colours ]
+    previous = self.colours[tileNumber]
+    if numpy is not None and isinstance(previous, numpy.ndarray):
+      previous = [ tuple(c) for c in previous.tolist() ]
+    changed = [ i for i in range(0, 64) if frame[i] != previous[i] ]
+    if len(changed) == 0:
+      self.framesSuppressed += 1
+      self.bytesSuppressed += 64 * self.bytesPerPixel
+      return self
+    x0 = min([ (i % 8) for i in changed ])
+    x1 = max([ (i % 8) for i in changed ])
+    y0 = min([ (i // 8) for i in changed ])
+    ## The tile fills the window row by row until it runs out of
+    ## colours or tile, so the window carries on to the bottom of the
+    ## tile and we send the current colours for those rows too.
+    window = [ frame[xy2pix(x, y)]
+               for y in range(y0, 8) for x in range(x0, x1 + 1) ]
+    return self.sendWindow(tileNumber=tileNumber, frame=frame,
+                           window=window, x=x0, y=y0, width=(x1 - x0 + 1),
+                           rapid=rapid)
+
+  def commitTileArray(self, tileNumber=None, colours=None, rapid=False):
+    ## The same as commitTileColours, for a frame held in a 64x4 array.
+    frame = colours.astype(numpy.uint16)
+    previous = numpy.asarray(self.colours[tileNumber], dtype=numpy.uint16)
+    changed = numpy.flatnonzero((frame != previous).any(axis=1))
+    if len(changed) == 0:
+      self.framesSuppressed += 1
+      self.bytesSuppressed += 64 * self.bytesPerPixel
+      return self
+    x0 = int((changed % 8).min())
+    x1 = int((changed % 8).max())
+    y0 = int((changed // 8).min())
+    window = frame.reshape(( 8, 8, 4 ))[y0:, x0:(x1 + 1)].reshape(( -1, 4 ))
+    return self.sendWindow(tileNumber=tileNumber, frame=frame,
+                           window=window.tolist(), x=x0, y=y0,
+                           width=(x1 - x0 + 1), rapid=rapid)
+
+  def sendWindow(self, tileNumber=None, frame=None, window=None,
+                 x=0, y=0, width=8, rapid=False):
+    ## Send the window of colours to the tile, and remember the
+    ## frame as what the tile is now showing. The message always
+    ## carries 64 colours, so the window is padded out to that.
+    nwindow = len(window)
+    window += [ ( 0, 0, 0, 0 ) ] * (64 - nwindow)
+    nbytes = 64 * self.bytesPerPixel
+    m = metrics()
+    startTime = m.startTimer()
     self.lifxTile.set_tile_colors(start_index=tileNumber,
-                                  colors=self.colours[tileNumber],
-                                  tile_count=1)
+                                  colors=window, tile_count=1,
+                                  x=x, y=y, width=width, rapid=rapid)
+    if startTime is not None:
+      labels = { "tile": tileNumber }
+      m.stopTimer("lan_send_seconds", startTime, labels)
+      m.count("lan_bytes_sent", nbytes, labels)
+    self.colours[tileNumber] = frame
+    self.framesSent += 1
+    self.bytesSent += nbytes
+    self.pixelsInWindows += nwindow
+    return self
+
+  def resetWriteStats(self):
+    self.framesSent = 0
+    self.framesSuppressed = 0
+    self.bytesSent = 0
+    self.bytesSuppressed = 0
+    self.pixelsInWindows = 0
+    return self
+
+  def getWriteStats(self):
+    ## How many frames and bytes of colour have been sent to the tiles,
+    ## and how many we didn't need to send because nothing changed.
+    ## pixelsInWindows is how many of the pixels sent were in the
+    ## windows the tiles actually redrew.
+    return { "framesSent": self.framesSent,
+             "framesSuppressed": self.framesSuppressed,
+             "bytesSent": self.bytesSent,
+             "bytesSuppressed": self.bytesSuppressed,
+             "pixelsInWindows": self.pixelsInWindows }
+
+  async def run(self, monica=None, pollTime=2):
+    ## Poll the MoniCA server and refresh the tiles from the one
+    ## event loop, instead of using a timer thread. The tiles are
+    ## refreshed every refreshTime seconds, as with the timer.
+    self.stop()
+    loop = asyncio.get_running_loop()
+    lastRefresh = None
+    while(True):
+      nextPoll = loop.time() + pollTime
+      if monica is not None:
+        await monica.updatePointsAsync()
+      if (lastRefresh is None or
+          (loop.time() - lastRefresh) >= self.refreshTime):
+        lastRefresh = loop.time()
+        self.refresh()
+      await asyncio.sleep(max(0, nextPoll - loop.time()))
 
   def stop(self):
     ## Stop automatically updating.
-    self.timer.stop()
+    if self.timer is not None:
+      self.timer.stop()
+    with self.dirtyLock:
+      if self.renderTimer is not None:
+        self.renderTimer.cancel()
+        self.renderTimer = None
+      self.renderPending = False
+      self.dirtyTiles = set()
@@ -0,0 +1,92 @@
+# coding=utf-8
+# virtual_tile.py
+# Author: Jamie Stevens
+# This file contains the VirtualTileChain class, which stands in for a
+# LIFX tile chain from lifxlan. It keeps the pixels in memory and
+# answers the calls the TileMaster makes, so the tiles can be driven
+# and benchmarked without any hardware.
+
+from .errors import ArgumentError
+from time import sleep
+import threading
+
+class VirtualTileChain:
+  def __init__(self, tileCount=5, latency=0, rapidLatency=0,
+               colour=( 0, 0, 32768, 3500 )):
+    ## The number of 8x8 tiles in the chain, and the colour (as HSBK)
+    ## they all start off showing.
+    self.tileCount = tileCount
+    self.colours = [ [ tuple(colour) ] * 64 for i in range(0, tileCount) ]
+    self.power = 0
+    ## The delay (in seconds) for each call that waits for the tiles
+    ## to answer, and for each call made with rapid set.
+    self.latency = latency
+    self.rapidLatency = rapidLatency
+    self.lock = threading.Lock()
+    self.resetStats()
+
+  def delay(self, rapid=False):
+    latency = self.rapidLatency if rapid == True else self.latency
+    if latency > 0:
+      sleep(latency)
+
+  def get_tile_count(self):
+    return self.tileCount
+
+  def get_tilechain_colors(self):
+    ## What each tile is showing, as a list of 64 HSBK tuples per tile.
+    self.delay()
+    with self.lock:
+      self.getCalls += 1
+      return [ list(t) for t in self.colours ]
+
+  def get_power(self):
+    self.delay()
+    return self.power
+
+  def set_power(self, power, duration=0, rapid=False):
+    self.delay(rapid)
+    with self.lock:
+      self.powerCalls += 1
+      self.power = 65535 if power in [ 1, "on", 65535 ] else 0
+    return self
+
+  def set_tile_colors(self, start_index, colors, duration=0, tile_count=1,
+                      x=0, y=0, width=8, rapid=False):
+    ## Like the tiles, the colours fill the window from (x, y), width
+    ## pixels to a row, until they run out or reach the bottom of the
+    ## tile; colours past the right hand edge are dropped.
+    if start_index < 0 or (start_index + tile_count) > self.tileCount:
+      raise ArgumentError(routine="VirtualTileChain.set_tile_colors",
+                          arg="start_index",
+                          message="is out of range")
+    self.delay(rapid)
+    with self.lock:
+      self.setCalls += 1
+      for t in range(start_index, start_index + tile_count):
+        tile = self.colours[t]
+        k = 0
+        for yy in range(y, 8):
+          for xx in range(x, x + width):
+            if k >= len(colors):
+              break
+            if xx < 8:
+              tile[xx + 8 * yy] = tuple(colors[k])
+              self.pixelsWritten += 1
+            k += 1
+    return self
+
+  def resetStats(self):
+    self.getCalls = 0
+    self.setCalls = 0
+    self.powerCalls = 0
+    self.pixelsWritten = 0
+    return self
+
+  def getStats(self):
+    ## How many of each call the chain has had, and how many pixels
+    ## have been written.
+    with self.lock:
+      return { "getCalls": self.getCalls, "setCalls": self.setCalls,
+               "powerCalls": self.powerCalls,
+               "pixelsWritten": self.pixelsWritten }
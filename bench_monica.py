@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# coding=utf-8
+# bench_monica.py
+# Author: Jamie Stevens
+# This benchmark polls a local MoniCA stand-in with growing numbers of
+# points, and reports how many polls a second a monicaServer manages,
+# and how long each stage of a poll (the HTTP request, decoding the
+# JSON and applying it to the points) takes.
+
+from atca_status_tile import monicaServer
+from atca_status_tile.monica_standin import monicaStandIn
+from time import perf_counter
+import argparse
+import asyncio
+
+## The stages reported, as named in monicaServer.getTimings.
+STAGES = [ "http", "decode", "apply", "total" ]
+
+def percentile(values=[], fraction=0.5):
+  ordered = sorted(values)
+  return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def benchmark(pointCount=200, seriesCount=0, seriesLength=60, churn=0.1,
+              latency=0, polls=20, shardSize=None, fullSeries=False,
+              useAsync=False):
+  ## Start a stand-in, register the points and series with a server
+  ## pointing at it, and time each poll. Returns the polls per second
+  ## and the timings of each stage of each poll.
+  ## The series cover an hour, so the sample period sets their length.
+  standIn = monicaStandIn({ "pointCount": pointCount, "churn": churn,
+                            "latency": latency,
+                            "samplePeriod": 3600. / seriesLength }).start()
+  info = standIn.getServerInfo()
+  info['shardSize'] = shardSize
+  ## The stand-in understands requests for just the new samples, so
+  ## we ask for them unless told otherwise.
+  if fullSeries == False:
+    info['seriesResyncPolls'] = 30
+  server = monicaServer(info)
+  for n in standIn.getPointNames():
+    server.addPoint(pointName=n)
+  for i in range(0, seriesCount):
+    server.addTimeSeries(pointName="synthetic.series%05d" % i,
+                         interval=60, startTime=-1)
+  loop = asyncio.new_event_loop() if useAsync == True else None
+  timings = { s: [] for s in STAGES }
+  try:
+    startTime = None
+    ## The first poll sets up the connections, so isn't counted.
+    for i in range(0, polls + 1):
+      if i == 1:
+        startTime = perf_counter()
+      if loop is not None:
+        loop.run_until_complete(server.updatePointsAsync())
+      else:
+        server.updatePoints()
+      if i > 0:
+        for s in STAGES:
+          timings[s].append(server.getTimings()[s])
+    elapsed = perf_counter() - startTime
+  finally:
+    server.close()
+    if loop is not None:
+      loop.close()
+    standIn.stop()
+  return ( polls / elapsed, timings )
+
+def main():
+  parser = argparse.ArgumentParser(description="Time monicaServer polls "
+                                   "against a local MoniCA stand-in.")
+  parser.add_argument("--points", type=int, nargs="+",
+                      default=[ 200, 1000, 2000, 5000 ],
+                      help="the numbers of points to try")
+  parser.add_argument("--series", type=int, default=0,
+                      help="how many time series to poll as well")
+  parser.add_argument("--series-length", type=int, default=60,
+                      help="how many samples each series has")
+  parser.add_argument("--full-series", action="store_true",
+                      help="get the whole of each series every poll")
+  parser.add_argument("--churn", type=float, default=0.1,
+                      help="the fraction of values changing each poll")
+  parser.add_argument("--latency", type=float, default=0,
+                      help="the delay (in seconds) of each response")
+  parser.add_argument("--polls", type=int, default=20,
+                      help="how many polls to time for each point count")
+  parser.add_argument("--shard-size", type=int, default=None,
+                      help="the most points asked for in one request")
+  parser.add_argument("--async", dest="useAsync", action="store_true",
+                      help="poll with updatePointsAsync")
+  args = parser.parse_args()
+
+  print("%7s %9s" % ("points", "polls/s") +
+        "".join([ " %10s %10s" % ("%s p50" % s, "%s p99" % s) for s in STAGES ]) +
+        "  (ms)")
+  for pointCount in args.points:
+    ( rate, timings ) = benchmark(
+      pointCount=pointCount, seriesCount=args.series,
+      seriesLength=args.series_length, churn=args.churn,
+      latency=args.latency, polls=args.polls, shardSize=args.shard_size,
+      fullSeries=args.full_series, useAsync=args.useAsync)
+    print("%7d %9.1f" % (pointCount, rate) +
+          "".join([ " %10.2f %10.2f" % (1000 * percentile(timings[s], 0.5),
+                                      1000 * percentile(timings[s], 0.99))
+                    for s in STAGES ]))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# coding=utf-8
+# bench_tiles.py
+# Author: Jamie Stevens
+# This benchmark builds the monitor1 layout on virtual tile chains of
+# increasing length (repeating the five monitor1 tiles along the chain)
+# and reports how long the TileMaster takes to refresh them all.
+
+from atca_status_tile import (TileMaster, monicaServer, VirtualTileChain,
+                              loadLayout, layoutFunctions)
+from atca_status_tile.monica_standin import monicaStandIn
+from time import perf_counter
+from fnmatch import fnmatch
+import argparse
+import json
+import os
+import random
+import tempfile
+
+## The monitor1 layout, in chain order, built as monitor1 builds it;
+## it is compiled into a directory of our own so the benchmark doesn't
+## touch the real cache.
+with tempfile.TemporaryDirectory(prefix="bench_tiles") as cacheDirectory:
+  LAYOUT = layoutFunctions(loadLayout(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "layouts",
+                 "monitor1.json"), cacheDirectory=cacheDirectory))
+
+## The values each point is given, chosen from the states its colour
+## rule looks for, so that changing them changes the tiles; the first
+## pattern the name matches is used.
+CHURN_VALUES = [
+  ( "*.cabb.correlator.Block*", [ "ONLINE", "OFFLINE" ] ),
+  ( "*.cryo.*.Summary", [ "OK", "FAULT" ] ),
+  ( "*.lightning.threat_int", [ "0", "1", "2", "3", "4" ] ),
+  ( "*.lightning.*", [ "0", "1", "5" ] ),
+  ( "*.power.powerSource", [ "mains", "GENERATOR", "SHARED_LOAD" ] ),
+  ( "*.servo.State", [ "STOWED", "PARKED", "SLEWING", "TRACKING",
+                       "DRIVE_ERROR" ] ),
+  ( "*.servo.AzWrap", [ "NORTH", "SOUTH" ] ),
+  ( "*.servo.AzError", [ "0\u00b00'0\".1", "0\u00b01'0\".0" ] ),
+  ( "*.servo.ElError", [ "0\u00b00'0\".1", "0\u00b01'0\".0" ] ),
+  ( "*.servo.RMSError", [ "0.5", "3", "30" ] ),
+  ( "*.misc.obs.caobsAntState", [ "STOWED", "SLEWING", "TRACKING",
+                                  "DRIVE_ERROR", "DISABLED", "OFF-LINE",
+                                  "IDLE" ] ),
+  ( "*.misc.obs.cycleNum", [ "cyc%d" % i for i in range(0, 64) ] ),
+  ( "*.misc.pmon.pmon_autostow", [ "OK", "STOW" ] ),
+  ( "*.weather.RainTips", [ "%d" % i for i in range(0, 16) ] ),
+  ( "*", [ "true", "false" ] )
+]
+
+def churnValues(pointName=None):
+  for ( pattern, values ) in CHURN_VALUES:
+    if fnmatch(pointName, pattern):
+      return values
+
+class standInTransport:
+  ## Answers the requests straight from a stand-in, without going
+  ## through HTTP, so only the rendering is being timed.
+  def __init__(self, standIn=None):
+    self.standIn = standIn
+
+  def post(self, url=None, data=None):
+    return json.dumps(self.standIn.buildResponse(data))
+
+def percentile(values=[], fraction=0.5):
+  ordered = sorted(values)
+  return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def benchmark(tileCount=5, refreshes=50, latency=0, churn=0.1,
+              useArrays=None):
+  ## Build the chain and the layout, then time each refresh after the
+  ## data has been updated, with the churn fraction of the points
+  ## given new values each time. Returns a dictionary of results.
+  chain = VirtualTileChain(tileCount=tileCount, latency=latency,
+                           rapidLatency=latency)
+  master = TileMaster(lifxTile=chain, autoRefresh=False, useArrays=useArrays)
+  standIn = monicaStandIn()
+  server = monicaServer({ "transport": standInTransport(standIn) })
+  for i in range(0, tileCount):
+    LAYOUT[i % len(LAYOUT)](tile=master.addTile(i), monica=server)
+  indicatorCount = sum([ len(t.indicators) for t in master.tiles
+                         if t is not None ])
+  pointNames = sorted(set([ k[0] for k in server.points ]))
+  ## The same values each run, so runs can be compared.
+  rng = random.Random(1)
+  for n in pointNames:
+    standIn.setValue(n, rng.choice(churnValues(n)))
+  server.updatePoints()
+  master.refresh()
+  master.resetWriteStats()
+  chain.resetStats()
+  times = []
+  for i in range(0, refreshes):
+    for n in rng.sample(pointNames, int(churn * len(pointNames))):
+      standIn.setValue(n, rng.choice(churnValues(n)))
+    server.updatePoints()
+    startTime = perf_counter()
+    master.refresh()
+    times.append(perf_counter() - startTime)
+  server.close()
+  return { "tiles": tileCount, "indicators": indicatorCount,
+           "p50": percentile(times, 0.5), "p99": percentile(times, 0.99),
+           "mean": sum(times) / len(times),
+           "framesSent": master.getWriteStats()['framesSent'],
+           "pixelsWritten": chain.getStats()['pixelsWritten'] }
+
+def main():
+  parser = argparse.ArgumentParser(description="Time TileMaster refreshes "
+                                   "on virtual tile chains.")
+  parser.add_argument("--tiles", type=int, nargs="+",
+                      default=[ 1, 5, 10, 20, 50 ],
+                      help="the chain lengths to try")
+  parser.add_argument("--refreshes", type=int, default=50,
+                      help="how many refreshes to time for each chain")
+  parser.add_argument("--latency", type=float, default=0,
+                      help="the delay (in seconds) of each tile call")
+  parser.add_argument("--churn", type=float, default=0.1,
+                      help="the fraction of points changed before each "
+                      "refresh")
+  parser.add_argument("--lists", action="store_true",
+                      help="keep the frames in lists rather than arrays")
+  args = parser.parse_args()
+  useArrays = False if args.lists == True else None
+
+  print("%6s %10s %9s %9s %9s %11s %9s %9s" %
+        ("tiles", "indicators", "p50 ms", "p99 ms", "mean ms",
+         "refresh/s", "frames", "pixels"))
+  for tileCount in args.tiles:
+    r = benchmark(tileCount=tileCount, refreshes=args.refreshes,
+                  latency=args.latency, churn=args.churn,
+                  useArrays=useArrays)
+    print("%6d %10d %9.3f %9.3f %9.3f %11.1f %9d %9d" %
+          (r['tiles'], r['indicators'], 1000 * r['p50'], 1000 * r['p99'],
+           1000 * r['mean'], 1 / r['mean'], r['framesSent'],
+           r['pixelsWritten']))
+
+if __name__ == "__main__":
+  main()
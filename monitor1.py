@@ -8,56 +8,55 @@
 # pattern.
 
 from lifxlan import *
-from atca_status_tile import TileMaster, initialiseServerInstance
+from atca_status_tile import (TileFleet, initialiseServerInstance,
+                              loadLayout, layoutFunctions)
 from time import sleep
-from tile_cabb_blocks import cabbBlockTile
-from tile_power_lightning import powerLightningTile
-from tile_cryogenics import cryogenicsTile
-from tile_weather import weatherTile
-from tile_observing import observingTile
+import os
+
+## What each tile of the chain shows, in order along the chain: CABB
+## blocks, lightning and power, cryogenics, weather and observing
+## status. The layout is compiled the first time it's seen, and the
+## compiled tables are kept for next time.
+LAYOUT = layoutFunctions(loadLayout(os.path.join(
+  os.path.dirname(os.path.abspath(__file__)), "layouts", "monitor1.json")))
 
 def main():
-  ## Get the tile we want to control.
-  lan = LifxLAN()
-  atcaTile = lan.get_tilechain_lights()[0]
+  ## Start the MoniCA machinery. The last values we knew are kept
+  ## on disk so we can show them straight away after a restart.
+  server = initialiseServerInstance({
+    'snapshotFile': os.path.expanduser("~/.atca_status_tile.snapshot") })
 
-  ## Initialise the tile master.
-  master = TileMaster(lifxTile=atcaTile,
-                      refreshTime=10)
+  ## Every tile chain we can find shows the same layout. The tiles
+  ## are redrawn when the data changes, so the timer is only a
+  ## keep-alive. Every few minutes the tiles are read back, so any
+  ## frame they missed gets sent again.
+  fleet = TileFleet(monica=server, refreshTime=60, minFrameInterval=0.5,
+                    verifyTime=180)
+  lan = LifxLAN()
+  for atcaTile in lan.get_tilechain_lights():
+    fleet.addDevice(lifxTile=atcaTile, layout=LAYOUT)
   ## Switch on the tiles.
-  master.powerOn()
+  fleet.powerOn()
 
-  ## Start the MoniCA machinery.
-  server = initialiseServerInstance()
-  
-  ## Tile 1: CABB block indicators.
-  tile1 = master.addTile(tileNumber=0)
-  cabbBlockTile(tile=tile1, monica=server)
-  
-  ## Tile 2: Lightning and power tile.
-  tile2 = master.addTile(tileNumber=1)
-  powerLightningTile(tile=tile2, monica=server)
+  ## The cryogenics summaries change slowly, so we don't need them
+  ## every poll unless they start changing.
+  server.setPollPeriod(pattern="*.cryo.*", period=30, minPeriod=2)
 
-  ## Tile 3: Cryogenics.
-  tile3 = master.addTile(tileNumber=2)
-  cryogenicsTile(tile=tile3, monica=server)
+  ## Redraw the tiles as soon as their points change.
+  fleet.start()
 
-  ## Tile 4: Weather.
-  tile4 = master.addTile(tileNumber=3)
-  weatherTile(tile=tile4, monica=server)
-  
-  ## Tile 5: Observing status.
-  tile5 = master.addTile(tileNumber=4)
-  observingTile(tile=tile5, monica=server)
+  ## Show the last known state until MoniCA gets back to us.
+  if server.loadSnapshot() > 0:
+    fleet.refresh()
   
-  ## Sit here and let the master do its work.
+  ## Sit here and let the fleet do its work.
   try:
     while(True):
-      server.updatePoints()
+      fleet.poll()
       sleep(2)
       
   finally:
-    master.stop()
+    fleet.stop()
       
 if __name__ == "__main__":
   main()
@@ -45,7 +45,7 @@ def threatLevelColour(threatStatus=None, parentTile=None):
       if (parentTile is not None):
         parentTile.callForAttention()
       return colours.ORANGE
-    if threatlevel == 4:
+    if threatLevel == 4:
       ## Storm stow, red.
       if (parentTile is not None):
         parentTile.callForAttention()
@@ -6,6 +6,7 @@
 
 from atca_status_tile import MoniCAPoint, StatusIndicator
 import atca_status_tile.colours as colours
+from functools import partial
 
 def ambientTemperatureColour(tempStatus=None):
   ## We simply look at whether the state is in error.
@@ -56,13 +57,30 @@ def pmonWindColour(windState=None, parentTile=None):
   parentTile.callForAttention()
   return colours.RED
 
+## The wind speeds (km/h) at which each of the four pixels in a
+## column of the wind plot light up, lowest first, and the colours
+## they light up. These should come from the site wind limits; until
+## they have been confirmed there are none, and the plot stays blank.
+windLevels = None
+windLevelColours = [ colours.GREEN[0], colours.YELLOW[0],
+                     colours.ORANGE[0], colours.RED[0] ]
+
 def siteWindColour(windSeries=None, parentTile=None):
   ## We have 7 columns of 4 pixels height to fill.
   ## The most recent wind is in the early part of the
   ## array we return, and each time needs four pixels.
   ## Low wind values have earlier pixels lit.
+  ## The series comes to us as the maximum wind in each of the
+  ## 7 columns, most recent first.
   pixelValues = [ colours.BLANK[0] ] * 28
-  print(windSeries['times'])
+  if windLevels is None:
+    return pixelValues
+  for i in range(0, len(windSeries)):
+    if windSeries[i] is None:
+      continue
+    for j in range(0, len(windLevels)):
+      if windSeries[i] >= windLevels[j]:
+        pixelValues[i * 4 + j] = windLevelColours[j]
   return pixelValues
 
 ## This routine takes a tile argument and puts all the weather
@@ -134,7 +152,8 @@ def weatherTile(tile=None, monica=None):
                                startTime=-1,
                                interval=30)
   siteWindIndicator = StatusIndicator(
-    computeFunction=siteWindStatus.getSeries,
+    computeFunction=partial(siteWindStatus.getBinnedSeries, nbins=7,
+                            statistic="max", newestFirst=True),
     colourFunction=siteWindColour)
   tile.addIndicator(indicator=siteWindIndicator,
                     x=[ 7, 7, 7, 7, 6, 6, 6, 6, 5, 5, 5, 5,